@@ -1,8 +1,9 @@
-import os, sys, json, asyncio, shutil, subprocess, time, zipfile, io
+import os, sys, json, asyncio, shutil, subprocess, time, zipfile, io, threading, re, hashlib
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Optional
 from fastapi import FastAPI, UploadFile, File, BackgroundTasks, Request
-from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
@@ -11,12 +12,18 @@ app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], all
 
 TRANSCRIBER_PATH = '/workspace/models/acestep-transcriber'
 CAPTIONER_PATH   = '/workspace/models/acestep-captioner'
-DATASETS_DIR     = '/workspace/datasets'
+DATASETS_DIR     = os.environ.get('DATASETS_DIR', '/workspace/datasets')
 TARGET_SR        = 16000
 MAX_SECONDS      = 60
 HF_TOKEN         = os.environ.get('HF_TOKEN', '')
+# Device de génération ; caption_worker.py épingle chaque worker (CUDA_VISIBLE_DEVICES ou cpu)
+CAPTION_DEVICE   = os.environ.get('CAPTION_DEVICE', 'cuda')
 
 AUDIO_EXTENSIONS = {'.wav', '.mp3', '.flac', '.aiff', '.aif', '.ogg', '.m4a'}
+# Sortie : un .txt tagué par piste, un manifest unique (captions.jsonl / captions.parquet), ou les deux
+OUTPUT_MODES     = {'txt', 'manifest', 'both'}
+MANIFEST_FORMATS = {'jsonl', 'parquet'}
+MANIFEST_NAME    = 'captions'
 
 os.makedirs(DATASETS_DIR, exist_ok=True)
 
@@ -32,6 +39,8 @@ state = {
     "models_loading": False,
     "selected_files": [],
     "output_dir": "",
+    "output_mode": "txt",
+    "manifest_format": "jsonl",
 }
 
 transcriber = None
@@ -44,6 +53,116 @@ def log(msg: str, level: str = "info"):
     state["log"].append(entry)
     print(f"[{entry['time']}] {msg}")
 
+@contextmanager
+def timed(timings, stage: str):
+    """Cumule la durée du bloc dans timings[stage] (secondes) ; sans effet si timings est None."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - t0
+
+# ── METRICS (format texte Prometheus) ─────────────────────
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Ajoute un en-tête Server-Timing à chaque réponse (désactivé par défaut)
+TIMING_HEADERS = os.environ.get("TIMING_HEADERS", "") == "1"
+
+_metrics_lock = threading.Lock()
+_metric_meta = {}   # nom -> (type, aide)
+_metric_values = {} # (nom, labels triés) -> valeur, ou [compteurs par bucket, somme, total] pour un histogramme
+
+def _labels_key(labels: dict):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name: str, value: float = 1, doc: str = "", **labels):
+    with _metrics_lock:
+        _metric_meta.setdefault(name, ("counter", doc))
+        key = (name, _labels_key(labels))
+        _metric_values[key] = _metric_values.get(key, 0) + value
+
+def set_gauge(name: str, value: float, doc: str = "", **labels):
+    with _metrics_lock:
+        _metric_meta.setdefault(name, ("gauge", doc))
+        _metric_values[(name, _labels_key(labels))] = value
+
+def observe(name: str, value: float, doc: str = "", buckets=LATENCY_BUCKETS, **labels):
+    with _metrics_lock:
+        _metric_meta.setdefault(name, ("histogram", doc))
+        key = (name, _labels_key(labels))
+        h = _metric_values.get(key)
+        if h is None:
+            h = _metric_values[key] = [dict.fromkeys(buckets, 0), 0.0, 0]
+        for b in h[0]:
+            if value <= b:
+                h[0][b] += 1
+        h[1] += value
+        h[2] += 1
+
+def _fmt_labels(pairs) -> str:
+    if not pairs:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        for name, (mtype, help_) in sorted(_metric_meta.items()):
+            if help_:
+                lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {mtype}")
+            for (n, labels), v in sorted(_metric_values.items()):
+                if n != name:
+                    continue
+                if mtype != "histogram":
+                    lines.append(f"{name}{_fmt_labels(labels)} {v}")
+                    continue
+                for b, count in v[0].items():
+                    lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', str(b)),))} {count}")
+                lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', '+Inf'),))} {v[2]}")
+                lines.append(f"{name}_sum{_fmt_labels(labels)} {v[1]}")
+                lines.append(f"{name}_count{_fmt_labels(labels)} {v[2]}")
+    return "\n".join(lines) + "\n"
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    t0 = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - t0
+    # Libellé = gabarit de route (pas l'URL brute) pour borner la cardinalité
+    route = getattr(request.scope.get("route"), "path", "other")
+    observe("http_request_duration_seconds", elapsed, "Latence des endpoints HTTP",
+            method=request.method, route=route, status=response.status_code)
+    if TIMING_HEADERS:
+        response.headers["Server-Timing"] = f"app;dur={elapsed * 1000:.1f}"
+    return response
+
+def record_caption_metrics(timings: dict):
+    """Reporte les durées d'un fichier (timings de caption_file) dans les métriques."""
+    for stage, v in timings.items():
+        if not stage.endswith('.tokens'):
+            observe("captioner_stage_seconds", v, "Durée des étapes du captioning par fichier", stage=stage)
+    for model in ('transcribe', 'caption'):
+        tokens, gen = timings.get(f'{model}.tokens'), timings.get(f'{model}.generate')
+        if tokens and gen:
+            inc("captioner_generated_tokens_total", tokens, "Tokens générés", model=model)
+            set_gauge("captioner_tokens_per_second", tokens / gen, "Débit de génération du dernier fichier", model=model)
+    try:
+        import torch
+        if torch.cuda.is_available():
+            set_gauge("captioner_gpu_memory_max_bytes", torch.cuda.max_memory_allocated(),
+                      "Pic de mémoire GPU allouée par torch")
+    except ImportError:
+        pass
+
+def record_analysis_batch_metrics(timings: dict, files: int):
+    """Durées d'un lot d'analyse (analyze_batch) : métrique séparée, captioner_stage_seconds reste par fichier."""
+    for stage, v in timings.items():
+        observe("captioner_analysis_batch_seconds", v, "Durée des étapes d'analyse par lot", stage=stage)
+    inc("captioner_analysis_batch_files_total", files, "Fichiers analysés par lot")
+
 # ── MOOSEFS CACHE FIX ─────────────────────────────────────
 
 def refresh_dir(path: str):
@@ -103,6 +222,7 @@ async def delete_file(path: str):
         shutil.rmtree(p)
     elif p.exists():
         p.unlink()
+    drop_manifest_rows([str(p)])
     return {"status": "deleted"}
 
 @app.post("/rename")
@@ -196,6 +316,7 @@ def install_deps():
         ['soundfile'],
         ['sentencepiece'],
         ['scipy==1.12.0'],
+        ['pyarrow'],
     ]
     for pkg in pkgs:
         cmd = [sys.executable, '-m', 'pip', 'install'] + pkg + ['--break-system-packages', '-q']
@@ -203,7 +324,6 @@ def install_deps():
         log(f"   {'✅' if r.returncode == 0 else '❌'} {pkg[0]}")
 
 async def download_and_load_models():
-    global transcriber, transcriber_proc, captioner, captioner_proc
     state["status"] = "downloading"
     state["models_loading"] = True
     install_deps()
@@ -219,6 +339,15 @@ async def download_and_load_models():
     else:
         log("✅ Modèles déjà présents")
     state["status"] = "loading"
+    load_models()
+    state["models_ready"] = True
+    state["models_loading"] = False
+    state["status"] = "idle"
+    log("🚀 Prêt — sélectionnez des fichiers audio et lancez le captioning", "success")
+
+def load_models():
+    """Charge transcriber et captioner sur CPU ; run_qwen_audio les passe à tour de rôle sur CAPTION_DEVICE."""
+    global transcriber, transcriber_proc, captioner, captioner_proc
     log("🔄 Chargement du transcriber...")
     import torch
     from transformers import Qwen2_5OmniForConditionalGeneration, Qwen2_5OmniProcessor
@@ -236,113 +365,433 @@ async def download_and_load_models():
     captioner.disable_talker()
     captioner_proc = Qwen2_5OmniProcessor.from_pretrained(CAPTIONER_PATH)
     log("✅ Captioner chargé")
-    state["models_ready"] = True
-    state["models_loading"] = False
-    state["status"] = "idle"
-    log("🚀 Prêt — sélectionnez des fichiers audio et lancez le captioning", "success")
 
-# ── CAPTIONING ────────────────────────────────────────────
+# ── ANALYSE AUDIO ─────────────────────────────────────────
+# Moteur par lots : décodage parallèle, un seul mélspectrogramme par clip pour le tempo et la mesure,
+# tonalité des 24 rotations de profils en un produit matriciel. Seul le mode fast empile les clips
+# d'un lot dans un même passage ; full garde un clip par passage (parité exacte avec l'analyse unitaire).
+#   full : signal complet à 22050 Hz, mêmes BPM / tonalité / mesure que l'analyse historique
+#   fast : extrait central de ANALYSIS_EXCERPT s à 11025 Hz, front-end calculé sur le lot empilé
+
+ANALYSIS_MODE    = os.environ.get('ANALYSIS_MODE', 'full')
+ANALYSIS_BATCH   = int(os.environ.get('ANALYSIS_BATCH', '8'))
+ANALYSIS_EXCERPT = float(os.environ.get('ANALYSIS_EXCERPT', '30'))
+# (sr, n_fft, hop) : même résolution temporelle (~43 images/s) dans les deux modes
+ANALYSIS_PARAMS  = {'full': (22050, 2048, 512), 'fast': (11025, 1024, 256)}
+
+KEY_NAMES   = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
+KEY_MAJOR   = [6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88]
+KEY_MINOR   = [6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17]
+_key_matrix = None
+
+def key_profiles():
+    """Les 24 rotations (12 majeures puis 12 mineures) des profils de Krumhansl, centrées-réduites."""
+    global _key_matrix
+    import numpy as np
+    if _key_matrix is None:
+        P = np.array([np.roll(prof, i) for prof in (KEY_MAJOR, KEY_MINOR) for i in range(12)], dtype=float)
+        _key_matrix = (P - P.mean(axis=1, keepdims=True)) / P.std(axis=1, keepdims=True)
+    return _key_matrix
+
+def estimate_keys(chroma):
+    """chroma (N, 12) → N tonalités. Corrélation de Pearson avec les 24 profils en un seul produit ;
+    à égalité le majeur l'emporte, comme dans l'ancienne boucle np.corrcoef."""
+    import numpy as np
+    c = chroma - chroma.mean(axis=1, keepdims=True)
+    c = c / np.maximum(c.std(axis=1, keepdims=True), 1e-12)
+    best = (c @ key_profiles().T / 12).argmax(axis=1)
+    return [f"{KEY_NAMES[b % 12]} {'major' if b < 12 else 'minor'}" for b in best]
+
+def estimate_meter(oe, beats):
+    import numpy as np
+    if len(beats) < 8:
+        return '4'
+    bs  = oe[beats]
+    acf = np.correlate(bs-bs.mean(), bs-bs.mean(), mode='full')[len(bs)-1:]
+    return '3' if (len(acf) > 4 and acf[3] > acf[4]*1.2) else '4'
+
+def _load_clip(audio_path, mode):
+    import librosa
+    sr = ANALYSIS_PARAMS[mode][0]
+    if mode == 'fast':
+        duration = librosa.get_duration(path=audio_path)
+        offset   = max(0.0, (duration - ANALYSIS_EXCERPT) / 2)
+        y, _ = librosa.load(audio_path, sr=sr, mono=True, offset=offset, duration=ANALYSIS_EXCERPT)
+    else:
+        y, _ = librosa.load(audio_path, sr=sr, mono=True)
+        duration = librosa.get_duration(y=y, sr=sr)
+    return y, duration
 
-def analyze_audio(audio_path):
+def _analyze_group(clips, mode, timings):
+    """Front-end commun d'un groupe de clips empilés (N, L) ; renvoie un dict par clip."""
     import numpy as np, librosa
-    MP = np.array([6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88])
-    mp = np.array([6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17])
-    KN = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
-    y, sr    = librosa.load(audio_path, sr=22050, mono=True)
-    duration = librosa.get_duration(y=y, sr=sr)
-    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-    if hasattr(tempo, '__len__'): tempo = tempo[0]
-    bpm   = int(round(float(tempo)))
-    chroma = librosa.feature.chroma_cqt(y=y, sr=sr).mean(axis=1)
-    mc = np.array([np.corrcoef(np.roll(MP,i), chroma)[0,1] for i in range(12)])
-    nc = np.array([np.corrcoef(np.roll(mp,i), chroma)[0,1] for i in range(12)])
-    bm, bn = mc.argmax(), nc.argmax()
-    keyscale = f'{KN[bm]} major' if mc[bm] >= nc[bn] else f'{KN[bn]} minor'
-    oe = librosa.onset.onset_strength(y=y, sr=sr)
-    _, beats = librosa.beat.beat_track(onset_envelope=oe, sr=sr)
-    if len(beats) >= 8:
-        bs = oe[beats]
-        acf = np.correlate(bs-bs.mean(), bs-bs.mean(), mode='full')[len(bs)-1:]
-        timesig = '3' if (len(acf) > 4 and acf[3] > acf[4]*1.2) else '4'
-    else:
-        timesig = '4'
-    return {'bpm': bpm, 'keyscale': keyscale, 'timesignature': timesig, 'duration': int(round(duration))}
+    sr, n_fft, hop = ANALYSIS_PARAMS[mode]
+    lengths = [len(y) for y, _ in clips]
+    frames  = [1 + n // hop for n in lengths]
+    Y = np.zeros((len(clips), max(lengths)), dtype=np.float32)
+    for row, (y, _) in enumerate(clips):
+        Y[row, :len(y)] = y
+    # Un clip seul passe en mono : chemin librosa identique à l'analyse historique
+    Yin = Y if len(clips) > 1 else Y[0]
+    with timed(timings, 'analyze.onset'):
+        M = librosa.feature.melspectrogram(y=Yin, sr=sr, n_fft=n_fft, hop_length=hop)
+        M = M.reshape((len(clips),) + M.shape[-2:])
+        S = np.stack([librosa.power_to_db(m) for m in M])  # top_db relatif à chaque clip, pas au lot
+        # beat_track(y=...) agrège en médiane, onset_strength par défaut en moyenne : en mode full on garde
+        # les deux (même spectrogramme) pour reproduire l'ancien tempo et l'ancienne mesure ; fast n'en garde qu'une
+        oe_tempo = librosa.onset.onset_strength(S=S, sr=sr, n_fft=n_fft, hop_length=hop, aggregate=np.median)
+        oe_meter = librosa.onset.onset_strength(S=S, sr=sr, n_fft=n_fft, hop_length=hop) if mode == 'full' else oe_tempo
+    with timed(timings, 'analyze.chroma_cqt'):
+        C = librosa.feature.chroma_cqt(y=Yin, sr=sr, hop_length=hop)
+        C = C.reshape((len(clips),) + C.shape[-2:])
+    with timed(timings, 'analyze.key'):
+        keys = estimate_keys(np.stack([C[row, :, :frames[row]].mean(axis=1) for row in range(len(clips))]))
+    out = []
+    for row, (_, duration) in enumerate(clips):
+        nf = frames[row]
+        with timed(timings, 'analyze.beat_track'):
+            tempo, beats = librosa.beat.beat_track(onset_envelope=oe_tempo[row, :nf], sr=sr, hop_length=hop)
+            bpm = int(round(float(np.atleast_1d(tempo)[0])))
+        with timed(timings, 'analyze.meter'):
+            if oe_meter is not oe_tempo:
+                _, beats = librosa.beat.beat_track(onset_envelope=oe_meter[row, :nf], sr=sr, hop_length=hop)
+            timesig = estimate_meter(oe_meter[row, :nf], beats)
+        out.append({'bpm': bpm, 'keyscale': keys[row], 'timesignature': timesig, 'duration': int(round(duration))})
+    return out
+
+def analyze_batch(audio_paths, mode=None, timings=None):
+    """
+    Analyse BPM / tonalité / mesure / durée d'un lot de fichiers. Renvoie une liste alignée sur
+    audio_paths : le dict d'analyse, ou l'exception levée pour ce fichier (un fichier illisible
+    n'invalide pas le lot).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    mode = mode or ANALYSIS_MODE
+    if mode not in ANALYSIS_PARAMS:
+        raise ValueError(f"ANALYSIS_MODE inconnu : {mode}")
+    results = [None] * len(audio_paths)
+    clips   = []
+    with timed(timings, 'analyze.decode'):
+        with ThreadPoolExecutor(max_workers=max(1, min(len(audio_paths), 4))) as pool:
+            futures = [pool.submit(_load_clip, p, mode) for p in audio_paths]
+        for i, fut in enumerate(futures):
+            try:
+                clips.append((i, fut.result()))
+            except Exception as e:
+                results[i] = e
+    # fast : extraits de longueur bornée, empilés en un seul groupe ; full : longueurs libres, un clip par groupe
+    groups = [clips] if mode == 'fast' else [[c] for c in clips]
+    for group in groups:
+        if not group:
+            continue
+        try:
+            for (i, _), res in zip(group, _analyze_group([c for _, c in group], mode, timings)):
+                results[i] = res
+        except Exception as e:
+            for i, _ in group:
+                results[i] = e
+    return results
+
+def analyze_audio(audio_path, timings=None, mode=None):
+    result = analyze_batch([audio_path], mode, timings)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
 
-def run_qwen_audio(model, other, processor, audio_data, sr, prompt):
+# ── CAPTIONING ────────────────────────────────────────────
+
+def run_qwen_audio(model, other, processor, audio_data, sr, prompt, timings=None, stage='generate'):
     import torch
-    other.to('cpu')
-    torch.cuda.empty_cache()
-    model.to('cuda')
+    with timed(timings, f'{stage}.swap'):
+        other.to('cpu')
+        torch.cuda.empty_cache()
+        model.to(CAPTION_DEVICE)
     conv = [{'role':'user','content':[
         {'type':'audio','audio':'<|audio_bos|><|AUDIO|><|audio_eos|>'},
         {'type':'text','text': prompt},
     ]}]
-    text   = processor.apply_chat_template(conv, add_generation_prompt=True, tokenize=False)
-    inputs = processor(text=text, audio=[audio_data], images=None, videos=None,
-                       return_tensors='pt', padding=True, sampling_rate=sr)
-    inputs = inputs.to(model.device).to(model.dtype)
-    with torch.no_grad():
-        ids = model.generate(**inputs, return_audio=False, max_new_tokens=512)
+    with timed(timings, f'{stage}.tokenize'):
+        text   = processor.apply_chat_template(conv, add_generation_prompt=True, tokenize=False)
+        inputs = processor(text=text, audio=[audio_data], images=None, videos=None,
+                           return_tensors='pt', padding=True, sampling_rate=sr)
+        inputs = inputs.to(model.device).to(model.dtype)
+    with timed(timings, f'{stage}.generate'):
+        with torch.no_grad():
+            ids = model.generate(**inputs, return_audio=False, max_new_tokens=512)
+    if timings is not None:
+        timings[f'{stage}.tokens'] = timings.get(f'{stage}.tokens', 0) + int(ids.shape[-1] - inputs['input_ids'].shape[-1])
     out = processor.batch_decode(ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)[0]
-    model.to('cpu')
-    torch.cuda.empty_cache()
+    with timed(timings, f'{stage}.swap'):
+        model.to('cpu')
+        torch.cuda.empty_cache()
     marker = 'assistant\n'
     if marker in out:
         out = out[out.rfind(marker)+len(marker):]
     return out.strip()
 
-async def run_captioning():
+CAPTION_PROMPT = '*Task* Describe this music in detail. Include genre, mood, instrumentation, tempo feel, and vocal style if present.'
+TRANSCRIBE_PROMPT = '*Task* Transcribe this audio in detail'
+
+def format_caption_txt(r: dict) -> str:
+    out  = f"<CAPTION>\n{r['caption']}\n</CAPTION>\n"
+    out += f"<LYRICS>\n{r['lyrics']}\n</LYRICS>\n"
+    out += f"<BPM>{r['bpm']}</BPM>\n"
+    out += f"<KEYSCALE>{r['keyscale']}</KEYSCALE>\n"
+    out += f"<TIMESIGNATURE>{r['timesignature']}</TIMESIGNATURE>\n"
+    out += f"<DURATION>{r['duration']}</DURATION>\n"
+    out += f"<LANGUAGE>{r['language']}</LANGUAGE>"
+    return out
+
+def caption_file(audio_path, output_dir, timings=None, write_txt=True, analysis=None):
+    """
+    Analyse + transcription + caption d'un fichier, écrit le .txt tagué (si write_txt) et retourne le résultat.
+    `analysis` : résultat déjà calculé par analyze_batch (dict, ou l'exception du fichier).
+    """
     import librosa as lb
+    filename  = os.path.basename(audio_path)
+    base_name = os.path.splitext(filename)[0]
+    txt_path  = os.path.join(output_dir, base_name + '.txt')
+    if isinstance(analysis, Exception):
+        raise analysis
+    if analysis is None:
+        with timed(timings, 'analyze'):
+            analysis = analyze_audio(audio_path, timings)
+    log(f"   BPM: {analysis['bpm']} | Key: {analysis['keyscale']} | {analysis['timesignature']}/4 | {analysis['duration']}s")
+    # librosa gère nativement WAV, MP3, FLAC, AIFF, OGG, M4A
+    with timed(timings, 'decode'):
+        audio_data, sr = lb.load(audio_path, sr=TARGET_SR, mono=True)
+        if len(audio_data) > MAX_SECONDS * TARGET_SR:
+            audio_data = audio_data[:MAX_SECONDS * TARGET_SR]
+    log("   📝 Transcription...")
+    with timed(timings, 'transcribe'):
+        lyrics = run_qwen_audio(transcriber, captioner, transcriber_proc, audio_data, TARGET_SR,
+                                TRANSCRIBE_PROMPT, timings, 'transcribe')
+    language = 'en'
+    if '# Languages' in lyrics and '# Lyrics' in lyrics:
+        language = lyrics.split('# Languages')[1].split('# Lyrics')[0].replace('\n','').strip()
+        lyrics   = lyrics.split('# Lyrics')[1].strip()
+    log("   🎼 Caption...")
+    with timed(timings, 'caption'):
+        caption = run_qwen_audio(captioner, transcriber, captioner_proc, audio_data, TARGET_SR,
+                                 CAPTION_PROMPT, timings, 'caption')
+    result = {'caption': caption, 'lyrics': lyrics, 'language': language, **analysis}
+    if write_txt:
+        with timed(timings, 'write'):
+            with open(txt_path, 'w', encoding='utf-8') as f:
+                f.write(format_caption_txt(result))
+    return result
+
+# ── MANIFEST ──────────────────────────────────────────────
+# Une ligne par piste dans captions.jsonl (ou captions.parquet) du dossier de sortie :
+# une seule lecture séquentielle au lieu de milliers de petits .txt sur le volume réseau.
+# En JSONL, la dernière ligne d'un même `path` fait foi.
+
+PROMPT_VERSION = hashlib.sha1((TRANSCRIBE_PROMPT + '\n' + CAPTION_PROMPT).encode()).hexdigest()[:8]
+CAPTION_TAGS   = ('CAPTION', 'LYRICS', 'BPM', 'KEYSCALE', 'TIMESIGNATURE', 'DURATION', 'LANGUAGE')
+
+def manifest_path(output_dir: str, fmt: str) -> str:
+    return os.path.join(output_dir, f'{MANIFEST_NAME}.{fmt}')
+
+def find_manifests(output_dir: str):
+    """[(chemin, format)] des manifests présents dans le dossier (normalement un seul)."""
+    found = []
+    for fmt in ('jsonl', 'parquet'):
+        p = manifest_path(output_dir, fmt)
+        if os.path.exists(p):
+            found.append((p, fmt))
+    return found
+
+def read_dir_manifest(output_dir: str) -> dict:
+    """Lignes de tous les manifests du dossier ; pour un même path, la plus récente (captioned_at) gagne."""
+    rows = {}
+    for path, fmt in find_manifests(output_dir):
+        for key, row in read_manifest(path, fmt).items():
+            if key not in rows or str(row.get('captioned_at', '')) >= str(rows[key].get('captioned_at', '')):
+                rows[key] = row
+    return rows
+
+def fold_manifests(output_dir: str, fmt: str) -> dict:
+    """Ramène le dossier à un seul manifest au format `fmt` : un manifest de l'autre format y est fusionné puis supprimé."""
+    target = manifest_path(output_dir, fmt)
+    others = [p for p, _ in find_manifests(output_dir) if p != target]
+    rows = read_dir_manifest(output_dir)
+    if others:
+        write_manifest(target, fmt, rows.values())
+        for p in others:
+            os.remove(p)
+    return rows
+
+def manifest_row(audio_path: str, result: dict) -> dict:
+    return {
+        'path': audio_path, 'caption': result['caption'], 'lyrics': result['lyrics'],
+        'bpm': result['bpm'], 'keyscale': result['keyscale'], 'timesignature': result['timesignature'],
+        'duration': result['duration'], 'language': result['language'],
+        'model': os.path.basename(CAPTIONER_PATH), 'transcriber': os.path.basename(TRANSCRIBER_PATH),
+        'prompt_version': PROMPT_VERSION, 'captioned_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def read_manifest(path: str, fmt: str) -> dict:
+    """Lignes du manifest indexées par `path` (la plus récente gagne)."""
+    rows = {}
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        for row in pq.read_table(path).to_pylist():
+            rows[row['path']] = row
+        return rows
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue  # ligne tronquée (arrêt brutal pendant l'écriture)
+            rows[row['path']] = row
+    return rows
+
+def write_manifest(path: str, fmt: str, rows):
+    """Réécriture complète atomique (fichier temporaire + rename)."""
+    tmp = f'{path}.tmp.{os.getpid()}'
+    if fmt == 'parquet':
+        import pyarrow as pa, pyarrow.parquet as pq
+        pq.write_table(pa.Table.from_pylist(list(rows)), tmp)
+    else:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def manifest_format_available(fmt: str) -> bool:
+    """Parquet dépend de pyarrow (optionnel) : à vérifier avant de lancer un run, pas au premier flush."""
+    if fmt != 'parquet':
+        return True
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def append_manifest(path: str, row: dict):
+    # Une ligne = un seul write en O_APPEND, puis fsync : jamais de ligne entrelacée.
+    # Si une écriture précédente a été coupée, on repart sur une nouvelle ligne.
+    sep = ''
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            sep = '' if f.read(1) == b'\n' else '\n'
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(sep + json.dumps(row, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def parse_caption_txt(text: str) -> dict:
+    out = {}
+    for tag in CAPTION_TAGS:
+        m = re.search(rf'<{tag}>\n?(.*?)\n?</{tag}>', text, re.S)
+        out[tag.lower()] = m.group(1).strip() if m else ''
+    for key in ('bpm', 'duration'):
+        out[key] = int(out[key]) if out[key].isdigit() else None
+    return out
+
+def _row_txt_name(row: dict) -> str:
+    return os.path.splitext(os.path.basename(row['path']))[0] + '.txt'
+
+def convert_txt_to_manifest(directory: str, fmt: str) -> int:
+    """Intègre les .txt tagués d'un dossier dans son manifest (les lignes déjà présentes sont conservées)."""
+    refresh_dir(directory)
+    names = os.listdir(directory)
+    audio_by_base = {os.path.splitext(n)[0]: os.path.join(directory, n) for n in names
+                     if os.path.splitext(n)[1].lower() in AUDIO_EXTENSIONS}
+    rows = read_dir_manifest(directory)
+    added = 0
+    for name in sorted(names):
+        if not name.endswith('.txt'):
+            continue
+        with open(os.path.join(directory, name), encoding='utf-8') as f:
+            parsed = parse_caption_txt(f.read())
+        if not parsed['caption']:
+            continue
+        base = os.path.splitext(name)[0]
+        audio = audio_by_base.get(base, os.path.join(directory, base))
+        if audio in rows:
+            continue
+        rows[audio] = {'path': audio, **parsed, 'model': '', 'transcriber': '', 'prompt_version': '',
+                       'captioned_at': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                                     time.localtime(os.path.getmtime(os.path.join(directory, name))))}
+        added += 1
+    write_manifest(manifest_path(directory, fmt), fmt, rows.values())
+    for path, _ in find_manifests(directory):
+        if path != manifest_path(directory, fmt):
+            os.remove(path)  # changement de format
+    return added
+
+def drop_manifest_rows(txt_paths):
+    """Supprime des manifests les lignes correspondant aux .txt supprimés depuis l'UI."""
+    by_dir = {}
+    for p in txt_paths:
+        if p.endswith('.txt'):
+            by_dir.setdefault(os.path.dirname(p), set()).add(os.path.basename(p))
+    for directory, names in by_dir.items():
+        for path, fmt in find_manifests(directory):
+            rows = read_manifest(path, fmt)
+            kept = [r for r in rows.values() if _row_txt_name(r) not in names]
+            if len(kept) != len(rows):
+                write_manifest(path, fmt, kept)
+
+async def run_captioning():
     os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'
     wav_paths  = state["selected_files"]
     output_dir = state["output_dir"]
+    mode, fmt  = state["output_mode"], state["manifest_format"]
     os.makedirs(output_dir, exist_ok=True)
+    manifest = manifest_path(output_dir, fmt) if mode != 'txt' else None
+    # Parquet ne s'ajoute pas en place : on garde les lignes en mémoire et on réécrit atomiquement
+    parquet_rows = read_manifest(manifest, fmt) if manifest and fmt == 'parquet' and os.path.exists(manifest) else {}
     state["total_files"] = len(wav_paths)
     state["processed"]   = 0
     state["errors"]      = 0
     state["status"]      = "running"
     log(f"🎵 {len(wav_paths)} fichiers à traiter", "success")
+    analyses = {}
     for i, audio_path in enumerate(wav_paths):
+        if ANALYSIS_BATCH > 1 and i % ANALYSIS_BATCH == 0:
+            chunk, batch_timings = wav_paths[i:i + ANALYSIS_BATCH], {}
+            try:
+                with timed(batch_timings, 'analyze'):
+                    analyses = dict(zip(chunk, analyze_batch(chunk, timings=batch_timings)))
+                record_analysis_batch_metrics(batch_timings, len(chunk))
+            except Exception as e:
+                log(f"⚠️ Analyse par lot impossible ({e}), analyse fichier par fichier", "error")
+                analyses = {}
         filename  = os.path.basename(audio_path)
-        base_name = os.path.splitext(filename)[0]
-        txt_path  = os.path.join(output_dir, base_name + '.txt')
         state["current_file"] = filename
         state["progress"] = int((i / len(wav_paths)) * 100)
         log(f"\n🎵 {filename}")
+        set_gauge("captioner_queue_depth", len(wav_paths) - i, "Fichiers restant à traiter dans le job courant")
         try:
-            analysis = analyze_audio(audio_path)
-            log(f"   BPM: {analysis['bpm']} | Key: {analysis['keyscale']} | {analysis['timesignature']}/4 | {analysis['duration']}s")
-            # librosa gère nativement WAV, MP3, FLAC, AIFF, OGG, M4A
-            audio_data, sr = lb.load(audio_path, sr=TARGET_SR, mono=True)
-            if len(audio_data) > MAX_SECONDS * TARGET_SR:
-                audio_data = audio_data[:MAX_SECONDS * TARGET_SR]
-            log("   📝 Transcription...")
-            lyrics = run_qwen_audio(transcriber, captioner, transcriber_proc, audio_data, TARGET_SR,
-                                    '*Task* Transcribe this audio in detail')
-            language = 'en'
-            if '# Languages' in lyrics and '# Lyrics' in lyrics:
-                language = lyrics.split('# Languages')[1].split('# Lyrics')[0].replace('\n','').strip()
-                lyrics   = lyrics.split('# Lyrics')[1].strip()
-            log("   🎼 Caption...")
-            caption = run_qwen_audio(captioner, transcriber, captioner_proc, audio_data, TARGET_SR,
-                                     '*Task* Describe this music in detail. Include genre, mood, instrumentation, tempo feel, and vocal style if present.')
-            out  = f"<CAPTION>\n{caption}\n</CAPTION>\n"
-            out += f"<LYRICS>\n{lyrics}\n</LYRICS>\n"
-            out += f"<BPM>{analysis['bpm']}</BPM>\n"
-            out += f"<KEYSCALE>{analysis['keyscale']}</KEYSCALE>\n"
-            out += f"<TIMESIGNATURE>{analysis['timesignature']}</TIMESIGNATURE>\n"
-            out += f"<DURATION>{analysis['duration']}</DURATION>\n"
-            out += f"<LANGUAGE>{language}</LANGUAGE>"
-            with open(txt_path, 'w', encoding='utf-8') as f:
-                f.write(out)
-            log(f"   ✅ {caption[:100]}...", "success")
+            timings = {}
+            result = caption_file(audio_path, output_dir, timings, write_txt=(mode != 'manifest'),
+                                  analysis=analyses.pop(audio_path, None))
+            if manifest:
+                with timed(timings, 'write'):
+                    row = manifest_row(audio_path, result)
+                    if fmt == 'parquet':
+                        parquet_rows[audio_path] = row
+                        write_manifest(manifest, fmt, parquet_rows.values())
+                    else:
+                        append_manifest(manifest, row)
+            record_caption_metrics(timings)
+            inc("captioner_files_total", 1, "Fichiers traités", result="ok")
+            log(f"   ✅ {result['caption'][:100]}...", "success")
             state["processed"] += 1
         except Exception as e:
+            inc("captioner_files_total", 1, "Fichiers traités", result="error")
             import traceback
             log(f"   ❌ {e}", "error")
             log(traceback.format_exc(), "error")
             state["errors"] += 1
         await asyncio.sleep(0)
+    set_gauge("captioner_queue_depth", 0)
     state["progress"] = 100
     state["status"]   = "done"
     log(f"\n✅ Terminé — {state['processed']} traités, {state['errors']} erreurs", "success")
@@ -377,25 +826,63 @@ async def start_captioning(request: Request):
     data = await request.json()
     audio_paths = data.get("files", [])
     output_dir  = data.get("output_dir", "")
+    output_mode = data.get("output_mode", "txt")
+    manifest_format = data.get("manifest_format", "jsonl")
+    if output_mode not in OUTPUT_MODES or manifest_format not in MANIFEST_FORMATS:
+        return JSONResponse({"error": "Mode de sortie invalide"}, status_code=400)
     if not audio_paths:
         return JSONResponse({"error": "Aucun fichier sélectionné"}, status_code=400)
     if not output_dir:
         return JSONResponse({"error": "Dossier de sortie non spécifié"}, status_code=400)
+    if not manifest_format_available(manifest_format):
+        return JSONResponse({"error": "pyarrow requis pour le format parquet"}, status_code=400)
+    if output_mode != 'txt' and os.path.isdir(output_dir):
+        # Un seul manifest par dossier : celui de l'autre format est fusionné avant le run
+        await asyncio.to_thread(fold_manifests, output_dir, manifest_format)
     state["selected_files"] = audio_paths
     state["output_dir"]     = output_dir
+    state["output_mode"]    = output_mode
+    state["manifest_format"] = manifest_format
     state["log"]            = []
     asyncio.create_task(run_captioning())
     return {"status": "started", "files": len(audio_paths)}
 
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/captions")
 async def list_captions():
-    """Liste tous les fichiers .txt dans /workspace/datasets et ses sous-dossiers."""
+    """
+    Liste les captions de /workspace/datasets et ses sous-dossiers. Dans un dossier qui a
+    un manifest, les lignes du manifest remplacent la lecture des .txt correspondants.
+    """
     result = []
     for root, dirs, files in os.walk(DATASETS_DIR):
         dirs[:] = [d for d in dirs if not d.startswith('.')]
         refresh_dir(root)
+        covered = set()
+        manifests = find_manifests(root)
+        if manifests:
+            mpath = manifests[0][0]
+            try:
+                rows = read_dir_manifest(root)
+            except Exception:
+                rows = {}
+            for row in sorted(rows.values(), key=_row_txt_name):
+                fname = _row_txt_name(row)
+                covered.add(fname)
+                text = format_caption_txt(row)
+                result.append({
+                    "name":     fname,
+                    "path":     os.path.join(root, fname),
+                    "rel_path": os.path.relpath(mpath, DATASETS_DIR),
+                    "size_kb":  round(len(text.encode('utf-8')) / 1024, 1),
+                    "preview":  text[:300],
+                    "source":   "manifest",
+                })
         for fname in sorted(files):
-            if not fname.endswith('.txt'):
+            if not fname.endswith('.txt') or fname in covered:
                 continue
             full = os.path.join(root, fname)
             rel  = os.path.relpath(full, DATASETS_DIR)
@@ -410,9 +897,27 @@ async def list_captions():
                 "rel_path": rel,
                 "size_kb":  size_kb,
                 "preview":  preview,
+                "source":   "txt",
             })
     return JSONResponse(result)
 
+@app.post("/manifest/convert")
+async def manifest_convert(request: Request):
+    """Convertit les .txt tagués d'un dossier en manifest JSONL/Parquet."""
+    data = await request.json()
+    directory = data.get("dir") or state["output_dir"]
+    fmt = data.get("format", "jsonl")
+    if not str(Path(directory)).startswith(DATASETS_DIR) or not os.path.isdir(directory):
+        return JSONResponse({"error": "Chemin non autorisé"}, status_code=403)
+    if fmt not in MANIFEST_FORMATS:
+        return JSONResponse({"error": "Format inconnu"}, status_code=400)
+    try:
+        added = await asyncio.to_thread(convert_txt_to_manifest, directory, fmt)
+    except ImportError:
+        return JSONResponse({"error": "pyarrow requis pour le format parquet"}, status_code=400)
+    log(f"📋 Manifest {fmt} : {added} caption(s) importée(s) depuis {directory}")
+    return {"status": "ok", "added": added, "manifest": manifest_path(directory, fmt)}
+
 @app.post("/delete-many")
 async def delete_many(request: Request):
     """Supprime une liste de fichiers ou dossiers."""
@@ -432,6 +937,7 @@ async def delete_many(request: Request):
             deleted += 1
         except Exception as e:
             errors.append(str(path) + " : " + str(e))
+    drop_manifest_rows([p for p in paths if str(Path(p)).startswith(DATASETS_DIR)])
     return {"deleted": deleted, "errors": errors}
 
 @app.get("/download-captions")
@@ -440,7 +946,8 @@ async def download_captions():
     if not output_dir or not os.path.exists(output_dir):
         return JSONResponse({"error": "Aucun dossier de sortie"}, status_code=404)
     refresh_dir(output_dir)
-    txts = [f for f in os.listdir(output_dir) if f.endswith('.txt')]
+    manifests = {f'{MANIFEST_NAME}.{fmt}' for fmt in MANIFEST_FORMATS}
+    txts = [f for f in os.listdir(output_dir) if f.endswith('.txt') or f in manifests]
     if not txts:
         return JSONResponse({"error": "Aucune caption générée"}, status_code=404)
     buf = io.BytesIO()
@@ -0,0 +1,312 @@
+"""
+Benchmark du pipeline de captioning (caption_file de app.py), étape par étape.
+
+Génère des fixtures audio synthétiques (accords + click track à BPM connu) en wav/mp3/flac,
+remplace les modèles Qwen par des stubs (tourne sur une machine CPU sans GPU ni poids),
+chronomètre chaque étape (decode, analyze.* , tokenize, generate, write) et écrit un JSON.
+Avec --baseline, compare les médianes à un run de référence et sort en code 1 sur régression.
+Avec --check-analysis, compare le moteur d'analyse par lots (modes full et fast) à l'analyse
+historique fichier par fichier sur un jeu de fixtures (BPM, tonalités, mesures variés) ; sort en
+code 1 si le mode full ne donne pas exactement les mêmes bpm / keyscale / timesignature.
+
+Exemples :
+    python bench_captioning.py --lengths 30 60 --formats wav mp3 flac --repeat 3 -o bench.json
+    python bench_captioning.py --baseline baseline.json --threshold 0.10
+    python bench_captioning.py --processor /workspace/models/acestep-captioner   # tokenisation réelle
+    python bench_captioning.py --check-analysis --lengths 30 180
+"""
+import os, sys, json, time, argparse, platform, statistics, subprocess, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DATASETS_DIR', tempfile.gettempdir())
+
+import numpy as np
+import soundfile as sf
+import torch
+
+import app as captioner_app
+
+KEY_ROOTS = ['C','C#','D','D#','E','F','F#','G','G#','A','A#','B']
+
+# ── FIXTURES ──────────────────────────────────────────────
+
+def synth_track(seconds: float, sr: int = 44100, bpm: int = 120, root: int = 0, beats_per_bar: int = 4,
+                minor: bool = False):
+    """Accord tenu sur `root` + click accentué à `bpm` : BPM, tonalité et mesure connus."""
+    n = int(seconds * sr)
+    t = np.arange(n) / sr
+    base = 261.63 * 2 ** (root / 12)
+    y = sum(np.sin(2 * np.pi * base * 2 ** (iv / 12) * t) for iv in (0, 3 if minor else 4, 7)) * 0.15
+    beat = 60.0 / bpm
+    click_len = int(0.03 * sr)
+    env = np.exp(-np.linspace(0, 8, click_len))
+    click = np.sin(2 * np.pi * 1000 * np.arange(click_len) / sr) * env
+    for k, start in enumerate(np.arange(0, seconds, beat)):
+        i = int(start * sr)
+        j = min(i + click_len, n)
+        y[i:j] += click[:j - i] * (0.9 if k % beats_per_bar == 0 else 0.45)
+    return (y / max(1e-9, np.abs(y).max()) * 0.8).astype(np.float32), sr
+
+def write_fixture(path: str, y, sr: int, fmt: str):
+    if fmt in ('wav', 'flac'):
+        sf.write(path, y, sr, format=fmt.upper())
+        return
+    try:
+        sf.write(path, y, sr, format='MP3')  # libsndfile >= 1.1
+    except Exception:
+        wav = path[:-4] + '.tmp.wav'
+        sf.write(wav, y, sr)
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', wav, path], check=True)
+        os.remove(wav)
+
+def make_fixtures(out_dir: str, lengths, formats, bpm: int, root: int):
+    os.makedirs(out_dir, exist_ok=True)
+    fixtures = []
+    for seconds in lengths:
+        y = sr = None
+        for fmt in formats:
+            path = os.path.join(out_dir, f'synth_{seconds}s_{bpm}bpm_{KEY_ROOTS[root]}.{fmt}')
+            if not os.path.exists(path):
+                if y is None:
+                    y, sr = synth_track(seconds, bpm=bpm, root=root)
+                write_fixture(path, y, sr, fmt)
+            fixtures.append({'path': path, 'seconds': seconds, 'format': fmt,
+                             'expected': {'bpm': bpm, 'keyscale': f'{KEY_ROOTS[root]} major'}})
+    return fixtures
+
+# ── STUBS ─────────────────────────────────────────────────
+
+class StubBatch(dict):
+    def to(self, *_args, **_kwargs):
+        return self
+
+class StubProcessor:
+    """Imite Qwen2_5OmniProcessor : features log-mel calculées en numpy, ids factices."""
+    def __init__(self, reply: str, n_mels: int = 128, n_fft: int = 400, hop: int = 160):
+        self.reply, self.n_mels, self.n_fft, self.hop = reply, n_mels, n_fft, hop
+
+    def apply_chat_template(self, conv, add_generation_prompt=True, tokenize=False):
+        return '\n'.join(c['text'] for m in conv for c in m['content'] if c['type'] == 'text')
+
+    def __call__(self, text, audio, sampling_rate, **_kwargs):
+        y = np.asarray(audio[0], dtype=np.float32)
+        frames = np.lib.stride_tricks.sliding_window_view(np.pad(y, (0, self.n_fft)), self.n_fft)[::self.hop]
+        spec = np.abs(np.fft.rfft(frames * np.hanning(self.n_fft), axis=-1)) ** 2
+        mel = np.log10(np.maximum(spec[:, :self.n_mels], 1e-10))
+        n_tokens = len(text.split()) + mel.shape[0] // 4
+        return StubBatch(input_ids=torch.ones((1, n_tokens), dtype=torch.long),
+                         input_features=torch.from_numpy(mel.T.copy()).unsqueeze(0))
+
+    def batch_decode(self, ids, **_kwargs):
+        return [f'user\n...\nassistant\n{self.reply}']
+
+class StubModel:
+    """Modèle factice : `generate` dort gen_ms puis renvoie new_tokens ids."""
+    def __init__(self, gen_ms: float, new_tokens: int):
+        self.gen_ms, self.new_tokens = gen_ms, new_tokens
+        self.device, self.dtype = torch.device('cpu'), torch.float32
+
+    def to(self, *_args, **_kwargs):
+        return self
+
+    def generate(self, input_ids=None, **_kwargs):
+        time.sleep(self.gen_ms / 1000)
+        return torch.cat([input_ids, torch.zeros((1, self.new_tokens), dtype=torch.long)], dim=-1)
+
+def install_stubs(args):
+    lyrics = '# Languages\nen\n# Lyrics\n[Instrumental]'
+    caption = 'A synthetic test track with a steady click and a sustained major chord.'
+    if args.processor:
+        from transformers import Qwen2_5OmniProcessor
+        proc = Qwen2_5OmniProcessor.from_pretrained(args.processor)
+        t_proc = c_proc = proc
+        # le vrai processeur décode les ids factices en texte vide : on garde la réponse du stub
+        proc.batch_decode = lambda ids, **kw: ['assistant\n' + caption]
+    else:
+        t_proc, c_proc = StubProcessor(lyrics), StubProcessor(caption)
+    captioner_app.transcriber = StubModel(args.gen_ms, args.new_tokens)
+    captioner_app.captioner = StubModel(args.gen_ms, args.new_tokens)
+    captioner_app.transcriber_proc, captioner_app.captioner_proc = t_proc, c_proc
+
+# ── RÉGRESSION DE L'ANALYSE ───────────────────────────────
+
+# (bpm, tonique, mineur, temps par mesure)
+ANALYSIS_CASES = [(120, 0, False, 4), (90, 9, True, 4), (140, 7, False, 3), (76, 2, True, 3), (128, 5, False, 4)]
+
+def make_analysis_fixtures(out_dir: str, lengths):
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for seconds in lengths:
+        for bpm, root, minor, bar in ANALYSIS_CASES:
+            path = os.path.join(out_dir, f"ana_{seconds}s_{bpm}bpm_{KEY_ROOTS[root]}{'m' if minor else ''}_{bar}.wav")
+            if not os.path.exists(path):
+                y, sr = synth_track(seconds, bpm=bpm, root=root, beats_per_bar=bar, minor=minor)
+                sf.write(path, y, sr)
+            paths.append(path)
+    return paths
+
+def reference_analyze(audio_path):
+    """L'analyse historique de app.py (avant le moteur par lots), gardée ici comme référence."""
+    import librosa
+    MP = np.array([6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88])
+    mp = np.array([6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17])
+    y, sr    = librosa.load(audio_path, sr=22050, mono=True)
+    duration = librosa.get_duration(y=y, sr=sr)
+    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+    if hasattr(tempo, '__len__'): tempo = tempo[0]
+    bpm    = int(round(float(tempo)))
+    chroma = librosa.feature.chroma_cqt(y=y, sr=sr).mean(axis=1)
+    mc = np.array([np.corrcoef(np.roll(MP,i), chroma)[0,1] for i in range(12)])
+    nc = np.array([np.corrcoef(np.roll(mp,i), chroma)[0,1] for i in range(12)])
+    bm, bn = mc.argmax(), nc.argmax()
+    keyscale = f'{KEY_ROOTS[bm]} major' if mc[bm] >= nc[bn] else f'{KEY_ROOTS[bn]} minor'
+    oe = librosa.onset.onset_strength(y=y, sr=sr)
+    _, beats = librosa.beat.beat_track(onset_envelope=oe, sr=sr)
+    if len(beats) >= 8:
+        bs = oe[beats]
+        acf = np.correlate(bs-bs.mean(), bs-bs.mean(), mode='full')[len(bs)-1:]
+        timesig = '3' if (len(acf) > 4 and acf[3] > acf[4]*1.2) else '4'
+    else:
+        timesig = '4'
+    return {'bpm': bpm, 'keyscale': keyscale, 'timesignature': timesig, 'duration': int(round(duration))}
+
+def check_analysis(paths, batch: int):
+    """Référence vs moteur full / fast : accord champ par champ et temps mur total."""
+    fields = ('bpm', 'keyscale', 'timesignature')
+    reference_analyze(paths[0])  # warmup : imports librosa / caches numba
+    t0 = time.perf_counter()
+    ref = [reference_analyze(p) for p in paths]
+    report = {'reference': {'seconds': time.perf_counter() - t0}}
+    for mode in ('full', 'fast'):
+        t0, got = time.perf_counter(), []
+        for i in range(0, len(paths), batch):
+            got += captioner_app.analyze_batch(paths[i:i + batch], mode)
+        elapsed = time.perf_counter() - t0
+        mismatches = [{'fixture': os.path.basename(p), 'reference': r,
+                       'got': g if isinstance(g, dict) else repr(g)}
+                      for p, r, g in zip(paths, ref, got)
+                      if not isinstance(g, dict) or any(g[k] != r[k] for k in fields)]
+        report[mode] = {'seconds': elapsed, 'speedup': report['reference']['seconds'] / elapsed if elapsed else None,
+                        'agreement': 1 - len(mismatches) / len(paths), 'mismatches': mismatches}
+    return report
+
+# ── RUN / REPORT ──────────────────────────────────────────
+
+def summarize(values):
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
+    return {'n': len(values), 'mean': statistics.fmean(values), 'median': statistics.median(values),
+            'p95': p95, 'min': values[0], 'max': values[-1]}
+
+def run_bench(fixtures, repeat: int, warmup: int, out_dir: str):
+    per_run, stage_samples = [], {}
+    for fx in fixtures:
+        for i in range(warmup + repeat):
+            timings = {}
+            t0 = time.perf_counter()
+            result = captioner_app.caption_file(fx['path'], out_dir, timings)
+            timings['total'] = time.perf_counter() - t0
+            if i < warmup:
+                continue  # imports librosa / caches numba
+            per_run.append({'fixture': os.path.basename(fx['path']), 'timings': timings,
+                            'bpm': result['bpm'], 'keyscale': result['keyscale'],
+                            'timesignature': result['timesignature'], 'expected': fx['expected']})
+            for stage, v in timings.items():
+                if not stage.endswith('.tokens'):
+                    stage_samples.setdefault(stage, []).append(v)
+    stages = {stage: summarize(v) for stage, v in sorted(stage_samples.items())}
+    audio_s = sum(fx['seconds'] for fx in fixtures) * repeat
+    wall_s = sum(r['timings']['total'] for r in per_run)
+    gen_s = sum(r['timings'].get(f'{s}.generate', 0) for r in per_run for s in ('transcribe', 'caption'))
+    tokens = sum(r['timings'].get(f'{s}.tokens', 0) for r in per_run for s in ('transcribe', 'caption'))
+    return {
+        'stages': stages,
+        'throughput': {'audio_seconds_per_second': audio_s / wall_s if wall_s else None,
+                       'files_per_minute': 60 * len(per_run) / wall_s if wall_s else None,
+                       'tokens_per_second': tokens / gen_s if gen_s else None},
+        'runs': per_run,
+    }
+
+def compare(current: dict, baseline: dict, threshold: float):
+    """Compare les médianes par étape ; renvoie (lignes du rapport, liste des régressions)."""
+    lines, regressions = [], []
+    lines.append(f"{'étape':<24}{'base (ms)':>12}{'actuel (ms)':>13}{'écart':>9}")
+    for stage, cur in current['stages'].items():
+        base = baseline.get('stages', {}).get(stage)
+        if not base:
+            lines.append(f"{stage:<24}{'—':>12}{cur['median'] * 1000:>13.1f}{'nouveau':>9}")
+            continue
+        delta = (cur['median'] - base['median']) / base['median'] if base['median'] else 0.0
+        flag = ''
+        if delta > threshold:
+            flag = '  ⚠️ régression'
+            regressions.append(stage)
+        lines.append(f"{stage:<24}{base['median'] * 1000:>12.1f}{cur['median'] * 1000:>13.1f}{delta:>+9.1%}{flag}")
+    return lines, regressions
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--lengths', type=float, nargs='+', default=[30, 60], help='durées des fixtures (s)')
+    ap.add_argument('--formats', nargs='+', default=['wav', 'mp3', 'flac'], choices=['wav', 'mp3', 'flac'])
+    ap.add_argument('--bpm', type=int, default=120)
+    ap.add_argument('--key', default='A', choices=KEY_ROOTS)
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--warmup', type=int, default=1)
+    ap.add_argument('--fixtures-dir', default=os.path.join(tempfile.gettempdir(), 'captioner-bench-fixtures'))
+    ap.add_argument('--gen-ms', type=float, default=0.0, help='latence simulée de generate (ms)')
+    ap.add_argument('--new-tokens', type=int, default=128, help='tokens produits par le stub')
+    ap.add_argument('--processor', default='', help='chemin d\'un processeur Qwen réel pour la tokenisation')
+    ap.add_argument('-o', '--output', default='bench_captioning.json')
+    ap.add_argument('--baseline', default='', help='JSON d\'un run précédent à comparer')
+    ap.add_argument('--threshold', type=float, default=0.10, help='régression tolérée sur la médiane')
+    ap.add_argument('--verbose', action='store_true', help='affiche les logs du pipeline')
+    ap.add_argument('--check-analysis', action='store_true', help='régression du moteur d\'analyse vs référence')
+    ap.add_argument('--batch', type=int, default=8, help='taille des lots pour --check-analysis')
+    args = ap.parse_args()
+
+    if args.check_analysis:
+        report = check_analysis(make_analysis_fixtures(args.fixtures_dir, args.lengths), args.batch)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"référence : {report['reference']['seconds']:.2f} s")
+        for mode in ('full', 'fast'):
+            r = report[mode]
+            print(f"{mode:<10}: {r['seconds']:.2f} s · x{r['speedup']:.2f} · accord {r['agreement']:.0%}")
+            for m in r['mismatches']:
+                print(f"    ≠ {m['fixture']} : référence {m['reference']} · obtenu {m['got']}")
+        sys.exit(1 if report['full']['mismatches'] else 0)
+
+    if not args.verbose:
+        captioner_app.log = lambda msg, level='info': None
+    install_stubs(args)
+    fixtures = make_fixtures(args.fixtures_dir, args.lengths, args.formats, args.bpm, KEY_ROOTS.index(args.key))
+    with tempfile.TemporaryDirectory() as out_dir:
+        report = run_bench(fixtures, args.repeat, args.warmup, out_dir)
+    report['meta'] = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+        'machine': platform.machine(), 'cpus': os.cpu_count(), 'torch_threads': torch.get_num_threads(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        'fixtures': [{k: fx[k] for k in ('path', 'seconds', 'format')} for fx in fixtures],
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'étape':<24}{'médiane (ms)':>14}{'p95 (ms)':>11}")
+    for stage, st in report['stages'].items():
+        print(f"{stage:<24}{st['median'] * 1000:>14.1f}{st['p95'] * 1000:>11.1f}")
+    tp = report['throughput']
+    print(f"\n{tp['audio_seconds_per_second']:.1f} s d'audio/s · {tp['files_per_minute']:.1f} fichiers/min"
+          f" · résultats → {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        lines, regressions = compare(report, baseline, args.threshold)
+        print('\n' + '\n'.join(lines))
+        if regressions:
+            print(f"\n❌ {len(regressions)} régression(s) > {args.threshold:.0%} : {', '.join(regressions)}")
+            sys.exit(1)
+        print('\n✅ Aucune régression')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+"""
+Captioning sans interface : découpe un dossier de dataset entre N workers (processus), sur un ou
+plusieurs pods qui partagent le volume réseau.
+
+Chaque worker charge ses propres modèles, épinglé sur un GPU (CUDA_VISIBLE_DEVICES) ou sur CPU
+avec un budget de threads, puis réclame les fichiers un par un via des fichiers de claim dans
+<sortie>/.claims/ (création O_EXCL, atomique sur MooseFS) : deux workers ne traitent jamais le
+même fichier, même depuis deux pods. Un claim dont le heartbeat s'arrête (worker tué) est repris
+après CLAIM_TTL secondes. Le traitement réutilise analyze_batch / caption_file de app.py.
+
+Chaque worker publie ses compteurs dans <sortie>/.claims/workers/ ; le lanceur affiche le débit
+agrégé de tous les workers (tous pods confondus) pendant le run, `status` l'affiche à la demande.
+
+Exemples :
+    python caption_worker.py run /workspace/datasets/songs --workers 2 --devices 0,1
+    python caption_worker.py run /workspace/datasets/songs --device cpu --workers 4 --threads 8
+    python caption_worker.py run /workspace/datasets/songs --output-mode manifest   # sur chaque pod
+    python caption_worker.py status /workspace/datasets/songs/captions
+    python caption_worker.py merge /workspace/datasets/songs/captions --format parquet
+"""
+import os, sys, json, time, socket, hashlib, argparse, threading, traceback
+import multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app as captioner_app
+
+CLAIM_TTL     = int(os.environ.get('CLAIM_TTL', '600'))
+CLAIMS_DIR    = '.claims'
+PARTS_DIR     = '.manifest-parts'
+
+# ── CLAIMS ────────────────────────────────────────────────
+# <h>.lock : en cours (mtime rafraîchi par le heartbeat) · <h>.done : fait · <h>.err : en échec
+
+def _claim_base(claims_dir: str, audio_path: str) -> str:
+    return os.path.join(claims_dir, hashlib.sha1(audio_path.encode()).hexdigest()[:20])
+
+def try_claim(claims_dir: str, audio_path: str, worker_id: str, retry_errors: bool = False) -> bool:
+    base = _claim_base(claims_dir, audio_path)
+    if os.path.exists(base + '.done') or (not retry_errors and os.path.exists(base + '.err')):
+        return False
+    lock = base + '.lock'
+    for _ in range(2):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock) < CLAIM_TTL:
+                    return False
+                # Claim orphelin : un seul worker gagne le rename, les autres retombent sur FileNotFoundError
+                aside = f'{lock}.stale.{worker_id}'
+                os.rename(lock, aside)
+                if time.time() - os.path.getmtime(aside) < CLAIM_TTL:
+                    # Entre notre lecture et le rename, un autre worker a repris le claim et en a créé
+                    # un neuf : on le remet en place (link n'écrase pas un lock recréé entre-temps)
+                    try:
+                        os.link(aside, lock)
+                    except FileExistsError:
+                        pass
+                    os.remove(aside)
+                    return False
+                os.remove(aside)
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'path': audio_path, 'worker': worker_id, 'time': time.time()}, f)
+        # Un autre worker a pu finir (lock → done) entre notre test et notre création
+        if os.path.exists(base + '.done'):
+            os.remove(lock)
+            return False
+        return True
+    return False
+
+def owns_claim(claims_dir: str, audio_path: str, worker_id: str) -> bool:
+    """Le lock porte l'id de son détenteur : seul celui qui y figure traite le fichier."""
+    try:
+        with open(_claim_base(claims_dir, audio_path) + '.lock', encoding='utf-8') as f:
+            return json.load(f).get('worker') == worker_id
+    except (OSError, ValueError):
+        return False
+
+def finish_claim(claims_dir: str, audio_path: str, ok: bool):
+    base = _claim_base(claims_dir, audio_path)
+    try:
+        os.replace(base + '.lock', base + ('.done' if ok else '.err'))
+        if ok and os.path.exists(base + '.err'):
+            os.remove(base + '.err')  # réussi avec --retry-errors
+    except FileNotFoundError:
+        pass  # claim repris par un autre worker après un heartbeat manqué
+
+class Heartbeat(threading.Thread):
+    """Rafraîchit le mtime des claims détenus pour qu'ils ne soient pas repris, et le fichier de statut du worker."""
+
+    def __init__(self, claims_dir: str, beat=None):
+        super().__init__(daemon=True)
+        self.claims_dir, self.held, self.lock, self.beat = claims_dir, set(), threading.Lock(), beat
+
+    def run(self):
+        while True:
+            time.sleep(max(1, CLAIM_TTL // 4))
+            if self.beat:
+                self.beat()
+            with self.lock:
+                held = list(self.held)
+            for p in held:
+                try:
+                    os.utime(_claim_base(self.claims_dir, p) + '.lock')
+                except FileNotFoundError:
+                    pass
+
+# ── WORKER ────────────────────────────────────────────────
+
+def list_audio(dataset_dir: str, output_dir: str):
+    out = []
+    for root, dirs, files in os.walk(dataset_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.')
+                         and os.path.join(root, d) != output_dir)
+        captioner_app.refresh_dir(root)
+        out += [os.path.join(root, f) for f in sorted(files)
+                if os.path.splitext(f)[1].lower() in captioner_app.AUDIO_EXTENSIONS]
+    return out
+
+def already_captioned(audio_path: str, output_dir: str, output_mode: str, manifest_rows) -> bool:
+    if output_mode == 'manifest':
+        return audio_path in manifest_rows
+    base = os.path.splitext(os.path.basename(audio_path))[0]
+    return os.path.exists(os.path.join(output_dir, base + '.txt'))
+
+_status_lock = threading.Lock()
+
+def write_status(status_path: str, stats: dict):
+    with _status_lock:  # worker + heartbeat
+        tmp = f'{status_path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(stats, f)
+        os.replace(tmp, status_path)
+
+def worker_main(index: int, args, env: dict):
+    os.environ.update(env)
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    captioner_app.CAPTION_DEVICE = 'cpu' if args.device == 'cpu' else 'cuda'
+    captioner_app.log = lambda msg, level='info': print(f'[{worker_id}] {msg.strip()}', flush=True)
+    import torch
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    output_dir = args.output_dir
+    claims_dir = os.path.join(output_dir, CLAIMS_DIR)
+    status_path = os.path.join(claims_dir, 'workers', worker_id + '.json')
+    part_path = os.path.join(output_dir, PARTS_DIR, worker_id + '.jsonl')
+    stats = {'worker': worker_id, 'device': env.get('CUDA_VISIBLE_DEVICES', args.device),
+             'started': time.time(), 'updated': time.time(), 'files': 0, 'errors': 0,
+             'audio_seconds': 0.0, 'current': '', 'running': True}
+    write_status(status_path, stats)
+
+    def beat():
+        stats['updated'] = time.time()
+        write_status(status_path, stats)
+
+    heartbeat = Heartbeat(claims_dir, beat)
+    heartbeat.start()
+    try:
+        captioner_app.load_models()
+        manifest_rows = load_all_manifest_rows(output_dir) if args.output_mode == 'manifest' else {}
+        files = list_audio(args.dataset_dir, output_dir)
+        # Chaque worker commence par sa part (index::total) puis vole le reste : peu de collisions de claims
+        total = args.pods * args.workers
+        k = args.pod_index * args.workers + index
+        order = files[k::total] + [f for i, f in enumerate(files) if i % total != k]
+
+        pending = iter(order)
+        while True:
+            batch = []
+            for audio_path in pending:
+                if already_captioned(audio_path, output_dir, args.output_mode, manifest_rows):
+                    continue
+                if try_claim(claims_dir, audio_path, worker_id, args.retry_errors):
+                    batch.append(audio_path)
+                    if len(batch) >= args.batch:
+                        break
+            if not batch:
+                break
+            with heartbeat.lock:
+                heartbeat.held.update(batch)
+            try:
+                analyses = dict(zip(batch, captioner_app.analyze_batch(batch, args.analysis_mode)))
+            except Exception as e:
+                captioner_app.log(f'⚠️ Analyse par lot impossible ({e}), analyse fichier par fichier', 'error')
+                analyses = {}
+            for audio_path in batch:
+                if not owns_claim(claims_dir, audio_path, worker_id):
+                    captioner_app.log(f'↪️ {audio_path} repris par un autre worker')
+                    with heartbeat.lock:
+                        heartbeat.held.discard(audio_path)
+                    continue
+                stats['current'] = audio_path
+                ok = False
+                try:
+                    result = captioner_app.caption_file(audio_path, output_dir, None,
+                                                        write_txt=(args.output_mode != 'manifest'),
+                                                        analysis=analyses.get(audio_path))
+                    if args.output_mode != 'txt':
+                        captioner_app.append_manifest(part_path, captioner_app.manifest_row(audio_path, result))
+                    stats['files'] += 1
+                    stats['audio_seconds'] += result['duration']
+                    ok = True
+                except Exception as e:
+                    stats['errors'] += 1
+                    captioner_app.log(f'❌ {audio_path} : {e}\n{traceback.format_exc()}', 'error')
+                if owns_claim(claims_dir, audio_path, worker_id):
+                    finish_claim(claims_dir, audio_path, ok)
+                with heartbeat.lock:
+                    heartbeat.held.discard(audio_path)
+                stats['updated'] = time.time()
+                write_status(status_path, stats)
+    finally:
+        stats.update(current='', running=False, updated=time.time())
+        write_status(status_path, stats)
+
+# ── MANIFEST ──────────────────────────────────────────────
+# Chaque worker écrit son propre fragment JSONL (pas d'append concurrent entre pods sur le volume réseau) ;
+# `merge` les replie dans captions.<format> une fois les workers terminés.
+
+def _part_files(output_dir: str):
+    parts_dir = os.path.join(output_dir, PARTS_DIR)
+    if not os.path.isdir(parts_dir):
+        return []
+    captioner_app.refresh_dir(parts_dir)
+    return [os.path.join(parts_dir, f) for f in sorted(os.listdir(parts_dir)) if f.endswith('.jsonl')]
+
+def load_all_manifest_rows(output_dir: str) -> dict:
+    rows = captioner_app.read_dir_manifest(output_dir)
+    for part in _part_files(output_dir):
+        rows.update(captioner_app.read_manifest(part, 'jsonl'))
+    return rows
+
+def merge_parts(output_dir: str, fmt: str) -> int:
+    parts = _part_files(output_dir)
+    if not parts:
+        return 0
+    rows = load_all_manifest_rows(output_dir)
+    target = captioner_app.manifest_path(output_dir, fmt)
+    captioner_app.write_manifest(target, fmt, rows.values())
+    for path, _ in captioner_app.find_manifests(output_dir):
+        if path != target:
+            os.remove(path)
+    for part in parts:
+        os.remove(part)
+    return len(rows)
+
+# ── RAPPORT ───────────────────────────────────────────────
+
+def read_statuses(output_dir: str):
+    wdir = os.path.join(output_dir, CLAIMS_DIR, 'workers')
+    if not os.path.isdir(wdir):
+        return []
+    captioner_app.refresh_dir(wdir)
+    out = []
+    for f in sorted(os.listdir(wdir)):
+        if f.endswith('.json'):
+            try:
+                with open(os.path.join(wdir, f), encoding='utf-8') as fh:
+                    out.append(json.load(fh))
+            except (OSError, ValueError):
+                continue  # en cours de remplacement
+    return out
+
+def aggregate(output_dir: str, since: float = 0.0) -> dict:
+    statuses = [s for s in read_statuses(output_dir) if s['updated'] >= since]
+    now = time.time()
+    claims_dir = os.path.join(output_dir, CLAIMS_DIR)
+    names = []
+    if os.path.isdir(claims_dir):
+        captioner_app.refresh_dir(claims_dir)
+        names = os.listdir(claims_dir)
+    files = sum(s['files'] for s in statuses)
+    audio = sum(s['audio_seconds'] for s in statuses)
+    start = min((s['started'] for s in statuses), default=time.time())
+    wall = max((s['updated'] for s in statuses), default=start) - start
+    return {
+        'workers': len(statuses), 'running': sum(1 for s in statuses if s['running'] and now - s['updated'] < CLAIM_TTL),
+        'files': files, 'errors': sum(s['errors'] for s in statuses),
+        'done': sum(1 for n in names if n.endswith('.done')),
+        'in_progress': sum(1 for n in names if n.endswith('.lock')),
+        'files_per_minute': 60 * files / wall if wall > 0 else None,
+        'audio_seconds_per_second': audio / wall if wall > 0 else None,
+    }
+
+def format_aggregate(a: dict) -> str:
+    fpm = f"{a['files_per_minute']:.1f}" if a['files_per_minute'] else '—'
+    aps = f"{a['audio_seconds_per_second']:.1f}" if a['audio_seconds_per_second'] else '—'
+    return (f"{a['running']}/{a['workers']} workers actifs · {a['files']} fichiers ({a['errors']} erreurs)"
+            f" · {a['done']} faits, {a['in_progress']} en cours · {fpm} fichiers/min · {aps} s d'audio/s")
+
+# ── CLI ───────────────────────────────────────────────────
+
+def cmd_run(args):
+    args.dataset_dir = os.path.abspath(args.dataset_dir)
+    args.output_dir = os.path.abspath(args.output_dir or os.path.join(args.dataset_dir, 'captions'))
+    if not captioner_app.models_present():
+        sys.exit("❌ Modèles absents : lancez l'interface une première fois pour les télécharger")
+    if not captioner_app.manifest_format_available(args.format):
+        sys.exit("❌ pyarrow requis pour le format parquet (pip install pyarrow)")
+    os.makedirs(os.path.join(args.output_dir, CLAIMS_DIR, 'workers'), exist_ok=True)
+    os.makedirs(os.path.join(args.output_dir, PARTS_DIR), exist_ok=True)
+    devices = [d for d in args.devices.split(',') if d] if args.devices else []
+    if args.device == 'cuda' and not devices:
+        import torch  # device_count passe par NVML, sans initialiser CUDA dans le lanceur
+        devices = [str(i) for i in range(torch.cuda.device_count())]
+    ctx = mp.get_context('spawn')  # torch / CUDA ne supportent pas fork après initialisation
+    procs, t0 = [], time.time()
+    for i in range(args.workers):
+        env = {'OMP_NUM_THREADS': str(args.threads)} if args.threads else {}
+        if args.device == 'cpu':
+            env['CUDA_VISIBLE_DEVICES'] = ''
+        elif devices:
+            env['CUDA_VISIBLE_DEVICES'] = devices[i % len(devices)]
+        p = ctx.Process(target=worker_main, args=(i, args, env), name=f'caption-worker-{i}')
+        p.start()
+        procs.append(p)
+    while any(p.is_alive() for p in procs):
+        time.sleep(args.report)
+        print('📊 ' + format_aggregate(aggregate(args.output_dir, since=t0)), flush=True)
+    for p in procs:
+        p.join()
+    print('✅ ' + format_aggregate(aggregate(args.output_dir, since=t0)), flush=True)
+    if args.output_mode != 'txt' and aggregate(args.output_dir)['running'] == 0:
+        n = merge_parts(args.output_dir, args.format)
+        print(f'📋 Manifest {args.format} : {n} ligne(s)')
+    failed = [p.name for p in procs if p.exitcode]
+    if failed:
+        sys.exit(f"❌ Workers en échec : {', '.join(failed)}")
+
+def cmd_status(args):
+    a = aggregate(os.path.abspath(args.output_dir))
+    print(json.dumps(a, indent=2) if args.json else format_aggregate(a))
+
+def cmd_merge(args):
+    output_dir = os.path.abspath(args.output_dir)
+    running = aggregate(output_dir)['running']
+    if running and not args.force:
+        sys.exit(f'❌ {running} worker(s) encore actif(s) ; --force pour fusionner quand même')
+    if not captioner_app.manifest_format_available(args.format):
+        sys.exit("❌ pyarrow requis pour le format parquet (pip install pyarrow)")
+    print(f'📋 Manifest {args.format} : {merge_parts(output_dir, args.format)} ligne(s)')
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest='cmd', required=True)
+
+    run = sub.add_parser('run', help='capte un dossier avec N workers')
+    run.add_argument('dataset_dir')
+    run.add_argument('-o', '--output-dir', default='', help='défaut : <dataset_dir>/captions')
+    run.add_argument('--workers', type=int, default=1, help='workers sur ce pod')
+    run.add_argument('--device', choices=['cuda', 'cpu'], default='cuda')
+    run.add_argument('--devices', default='', help='GPU attribués en tourniquet, ex. 0,1')
+    run.add_argument('--threads', type=int, default=0, help='threads torch par worker (0 : défaut torch)')
+    run.add_argument('--pods', type=int, default=1, help='nombre de pods lancés sur le même dataset')
+    run.add_argument('--pod-index', type=int, default=0, help='rang de ce pod (répartition initiale)')
+    run.add_argument('--batch', type=int, default=captioner_app.ANALYSIS_BATCH, help='fichiers réclamés et analysés par lot')
+    run.add_argument('--analysis-mode', choices=sorted(captioner_app.ANALYSIS_PARAMS), default=captioner_app.ANALYSIS_MODE)
+    run.add_argument('--output-mode', choices=sorted(captioner_app.OUTPUT_MODES), default='txt')
+    run.add_argument('--format', choices=sorted(captioner_app.MANIFEST_FORMATS), default='jsonl', help='format du manifest final')
+    run.add_argument('--retry-errors', action='store_true', help='reprend les fichiers marqués en échec')
+    run.add_argument('--report', type=float, default=30, help='intervalle du rapport de débit (s)')
+    run.set_defaults(func=cmd_run)
+
+    st = sub.add_parser('status', help='débit agrégé de tous les workers d\'un dossier de sortie')
+    st.add_argument('output_dir')
+    st.add_argument('--json', action='store_true')
+    st.set_defaults(func=cmd_status)
+
+    mg = sub.add_parser('merge', help='fusionne les fragments de manifest des workers')
+    mg.add_argument('output_dir')
+    mg.add_argument('--format', choices=sorted(captioner_app.MANIFEST_FORMATS), default='jsonl')
+    mg.add_argument('--force', action='store_true')
+    mg.set_defaults(func=cmd_merge)
+
+    args = ap.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
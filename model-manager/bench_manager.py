@@ -0,0 +1,294 @@
+"""
+Benchmark / test de charge des endpoints du Model Manager, hors ligne.
+
+Construit un faux BASE_MODELS_PATH (fichiers sparse : tailles apparentes de plusieurs To
+sans consommer le disque), lance un faux serveur JSON-RPC aria2 qui simule des centaines
+de téléchargements, démarre manager_app sous uvicorn puis le sollicite avec N clients
+concurrents. Rapporte débit et percentiles de latence par endpoint (tableau + JSON).
+
+Exemples :
+    python bench_manager.py --files 10000 --downloads 300 --clients 16 --duration 20
+    python bench_manager.py --endpoints /scan-disk /progress -o bench_manager.json
+"""
+import os, sys, json, time, random, socket, argparse, tempfile, threading, statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+DEFAULT_ENDPOINTS = ["/scan-disk", "/disk-usage", "/progress", "/list-subfolders?category=loras",
+                     "/config", "/catalogue/status", "/metrics"]
+CATEGORIES = ["checkpoints", "diffusion_models", "loras", "vae", "text_encoders", "unet", "upscale_models"]
+FOLDER_CATEGORIES = ["LLM", "prompt_generator"]
+EXTENSIONS = [".safetensors", ".gguf", ".pth", ".bin"]
+
+# ── ARBORESCENCE SYNTHÉTIQUE ──────────────────────────────
+
+def build_tree(root: str, n_files: int, total_tb: float, depth: int, seed: int):
+    """Crée n_files fichiers sparse répartis en catégories / sous-dossiers ; retourne le catalogue associé."""
+    rng = random.Random(seed)
+    # Tailles log-normales (LoRA de quelques Mo → checkpoints de dizaines de Go), normalisées à total_tb
+    raw = [rng.lognormvariate(0, 1.6) for _ in range(n_files)]
+    scale = total_tb * 1024 ** 4 / sum(raw)
+    catalogue = {}
+    for i, weight in enumerate(raw):
+        cat = CATEGORIES[i % len(CATEGORIES)]
+        sub = "/".join(f"d{rng.randrange(8)}" for _ in range(rng.randrange(depth + 1)))
+        name = f"model_{i:05d}{rng.choice(EXTENSIONS)}"
+        folder = os.path.join(root, cat, sub)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, name), "wb") as f:
+            f.truncate(max(1, int(weight * scale)))
+        family = f"Famille {i % 12}"
+        catalogue.setdefault(family, {}).setdefault(cat, []).append(
+            {"name": name, "url": f"https://huggingface.co/bench/{name}", "path": cat, "filename": name, "category": cat})
+    for cat in FOLDER_CATEGORIES:
+        for j in range(4):
+            folder = os.path.join(root, cat, f"llm_{j}")
+            os.makedirs(folder, exist_ok=True)
+            for k in range(6):
+                with open(os.path.join(folder, f"shard_{k}.safetensors"), "wb") as f:
+                    f.truncate(5 * 1024 ** 3)
+    # Entrées absentes du disque pour que la jointure « missing » soit exercée
+    for i in range(n_files // 10):
+        catalogue.setdefault("Famille absente", {}).setdefault("loras", []).append(
+            {"name": f"absent_{i}", "url": "https://civitai.com/api/download/models/1", "path": "loras",
+             "filename": f"absent_{i}.safetensors", "category": "loras"})
+    return catalogue
+
+# ── FAUX ARIA2 ────────────────────────────────────────────
+
+class FakeAria2:
+    """État des téléchargements simulés ; la progression avance avec le temps réel."""
+    def __init__(self, n_downloads: int, root: str, seed: int):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.downloads, self.order = {}, []
+        self.started = time.time()
+        self.global_options = {}
+        for i in range(n_downloads):
+            status = rng.choices(["active", "waiting", "paused", "complete", "error"], [4, 3, 1, 2, 1])[0]
+            self._add(f"https://huggingface.co/bench/dl_{i}.safetensors", {"dir": os.path.join(root, "loras"),
+                      "out": f"dl_{i}.safetensors"}, status, rng.randrange(50, 20_000) * 1024 ** 2,
+                      rng.randrange(1, 80) * 1024 ** 2)
+
+    def _add(self, uri, options, status, total, speed):
+        gid = f"{len(self.order) + 1:016x}"
+        self.downloads[gid] = {"gid": gid, "status": status, "total": total, "speed": speed,
+                               "created": time.time(), "uri": uri, "dir": options.get("dir", "/tmp"),
+                               "out": options.get("out", uri.rsplit("/", 1)[-1]), "options": dict(options)}
+        self.order.append(gid)
+        return gid
+
+    def _struct(self, d):
+        elapsed = time.time() - d["created"]
+        done = d["total"] if d["status"] == "complete" else \
+            min(d["total"], int(d["speed"] * elapsed)) if d["status"] == "active" else d["total"] // 3
+        speed = d["speed"] if d["status"] == "active" else 0
+        path = os.path.join(d["dir"], d["out"])
+        return {
+            "gid": d["gid"], "status": d["status"], "totalLength": str(d["total"]), "completedLength": str(done),
+            "uploadLength": "0", "downloadSpeed": str(speed), "uploadSpeed": "0", "connections": "8",
+            "numPieces": str(max(1, d["total"] // 1048576)), "pieceLength": "1048576", "dir": d["dir"],
+            "errorCode": "1" if d["status"] == "error" else "0", "errorMessage": "",
+            "files": [{"index": "1", "path": path, "length": str(d["total"]), "completedLength": str(done),
+                       "selected": "true", "uris": [{"uri": d["uri"], "status": "used"}]}],
+        }
+
+    def _list(self, statuses, offset=0, num=1000):
+        gids = [g for g in self.order if self.downloads[g]["status"] in statuses]
+        return [self._struct(self.downloads[g]) for g in gids[offset:offset + num]]
+
+    def call(self, method, params):
+        params = [p for p in params if not (isinstance(p, str) and p.startswith("token:"))]
+        m = method.replace("aria2.", "")
+        with self.lock:
+            if m == "getVersion":
+                return {"version": "1.37.0", "enabledFeatures": []}
+            if m == "tellActive":
+                return self._list({"active"})
+            if m == "tellWaiting":
+                return self._list({"waiting", "paused"}, *params[:2])
+            if m == "tellStopped":
+                return self._list({"complete", "error", "removed"}, *params[:2])
+            if m == "tellStatus":
+                return self._struct(self.downloads[params[0]])
+            if m == "getGlobalStat":
+                counts = {s: sum(1 for d in self.downloads.values() if d["status"] == s)
+                          for s in ("active", "waiting", "paused", "complete", "error")}
+                speed = sum(d["speed"] for d in self.downloads.values() if d["status"] == "active")
+                return {"downloadSpeed": str(speed), "uploadSpeed": "0", "numActive": str(counts["active"]),
+                        "numWaiting": str(counts["waiting"] + counts["paused"]),
+                        "numStopped": str(counts["complete"] + counts["error"]),
+                        "numStoppedTotal": str(counts["complete"] + counts["error"])}
+            if m == "addUri":
+                opts = params[1] if len(params) > 1 else {}
+                status = "paused" if opts.get("pause") == "true" else "waiting"
+                return self._add(params[0][0], opts, status, 2 * 1024 ** 3, 40 * 1024 ** 2)
+            if m == "unpause":
+                self.downloads[params[0]]["status"] = "active"
+                self.downloads[params[0]]["created"] = time.time()
+                return params[0]
+            if m == "changeOption":
+                self.downloads[params[0]]["options"].update(params[1])
+                return "OK"
+            if m == "changeGlobalOption":
+                self.global_options.update(params[0])
+                return "OK"
+            if m == "changePosition":
+                return params[1]
+            if m == "purgeDownloadResult":
+                for g in [g for g in self.order if self.downloads[g]["status"] in ("complete", "error", "removed")]:
+                    self.order.remove(g)
+                    del self.downloads[g]
+                return "OK"
+        raise ValueError(f"méthode non simulée : {method}")
+
+def serve_fake_aria2(fake: FakeAria2, port: int):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            reqs = body if isinstance(body, list) else [body]
+            out = []
+            for req in reqs:
+                try:
+                    if req["method"] == "system.multicall":
+                        result = [[fake.call(c["methodName"], c.get("params", []))] for c in req["params"][0]]
+                    else:
+                        result = fake.call(req["method"], req.get("params", []))
+                    out.append({"jsonrpc": "2.0", "id": req.get("id"), "result": result})
+                except Exception as e:
+                    out.append({"jsonrpc": "2.0", "id": req.get("id"), "error": {"code": 1, "message": str(e)}})
+            raw = json.dumps(out if isinstance(body, list) else out[0]).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def log_message(self, *_args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, name="fake-aria2", daemon=True).start()
+    return server
+
+# ── CHARGE ────────────────────────────────────────────────
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_manager(port: int):
+    import uvicorn
+    import manager_app
+    config = uvicorn.Config(manager_app.app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, name="manager", daemon=True).start()
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/sync-status", timeout=1)
+            return server
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError("le manager n'a pas démarré")
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def load_endpoint(base: str, endpoint: str, clients: int, duration: float):
+    """`clients` threads enchaînent des GET pendant `duration` secondes."""
+    deadline = time.time() + duration
+    lat, errors = [], 0
+    lock = threading.Lock()
+
+    def worker():
+        nonlocal errors
+        session = requests.Session()
+        while time.time() < deadline:
+            t0 = time.perf_counter()
+            try:
+                ok = session.get(base + endpoint, timeout=120).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - t0
+            with lock:
+                lat.append(elapsed)
+                errors += 0 if ok else 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        for _ in range(clients):
+            pool.submit(worker)
+    wall = time.perf_counter() - t0
+    if not lat:
+        return {"requests": 0, "errors": errors}
+    return {"requests": len(lat), "errors": errors, "rps": len(lat) / wall,
+            "mean_ms": statistics.fmean(lat) * 1000, "p50_ms": percentile(lat, 0.50) * 1000,
+            "p90_ms": percentile(lat, 0.90) * 1000, "p99_ms": percentile(lat, 0.99) * 1000,
+            "max_ms": max(lat) * 1000}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--files", type=int, default=2000, help="nombre de modèles synthétiques (jusqu'à 10k+)")
+    ap.add_argument("--total-tb", type=float, default=4.0, help="taille apparente totale (sparse)")
+    ap.add_argument("--depth", type=int, default=2, help="profondeur max des sous-dossiers")
+    ap.add_argument("--downloads", type=int, default=300, help="téléchargements simulés dans le faux aria2")
+    ap.add_argument("--clients", type=int, default=8)
+    ap.add_argument("--duration", type=float, default=10.0, help="secondes de charge par endpoint")
+    ap.add_argument("--endpoints", nargs="+", default=DEFAULT_ENDPOINTS)
+    ap.add_argument("--workdir", default="", help="réutilise une arborescence existante (sinon dossier temporaire)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("-o", "--output", default="bench_manager.json")
+    args = ap.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="manager-bench-")
+    models = os.path.join(workdir, "models")
+    config_path = os.path.join(workdir, "models.json")
+    if not os.path.exists(config_path):
+        t0 = time.perf_counter()
+        catalogue = build_tree(models, args.files, args.total_tb, args.depth, args.seed)
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(catalogue, f, indent=4)
+        print(f"🌳 {args.files} fichiers sparse ({args.total_tb} To apparents) en {time.perf_counter() - t0:.1f}s → {workdir}")
+
+    aria2_port, manager_port = free_port(), free_port()
+    os.environ["ARIA2_RPC_PORT"] = str(aria2_port)
+    os.environ["GITHUB_TOKEN"] = ""  # jamais de push GitHub pendant un bench
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import manager_app
+    manager_app.BASE_MODELS_PATH = models
+    manager_app.CONFIG_PATH = config_path
+    manager_app.ARIA2_SESSION_PATH = os.path.join(workdir, "aria2.session")
+    manager_app.DOWNLOAD_JOURNAL_PATH = os.path.join(workdir, "downloads.json")
+    # Le hook de démarrage écrit extra_model_paths.yaml et crée le cache local : rien hors du workdir
+    manager_app.COMFYUI_PATH = workdir
+    manager_app.LOCAL_CACHE_PATH = os.path.join(workdir, "model-cache")
+    manager_app.CACHE_INDEX_PATH = os.path.join(manager_app.LOCAL_CACHE_PATH, ".index.json")
+
+    serve_fake_aria2(FakeAria2(args.downloads, models, args.seed), aria2_port)
+    start_manager(manager_port)
+    base = f"http://127.0.0.1:{manager_port}"
+
+    results = {}
+    print(f"\n{'endpoint':<34}{'req/s':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'err':>6}")
+    for ep in args.endpoints:
+        requests.get(base + ep, timeout=300)  # échauffement (caches, imports)
+        r = results[ep] = load_endpoint(base, ep, args.clients, args.duration)
+        if r["requests"]:
+            print(f"{ep:<34}{r['rps']:>9.1f}{r['p50_ms']:>9.1f}{r['p90_ms']:>9.1f}"
+                  f"{r['p99_ms']:>9.1f}{r['max_ms']:>9.1f}{r['errors']:>6}")
+        else:
+            print(f"{ep:<34}{'—':>9}  aucune réponse ({r['errors']} erreurs)")
+
+    report = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "cpus": os.cpu_count(),
+                       **{k: v for k, v in vars(args).items() if k != "output"}, "workdir": workdir},
+              "endpoints": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nlatences en ms · résultats → {args.output}")
+
+if __name__ == "__main__":
+    main()
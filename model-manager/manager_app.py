@@ -1,13 +1,19 @@
-import os, json, aria2p, subprocess, time, uvicorn, shutil, psutil, requests, base64, re
+import os, json, aria2p, subprocess, time, uvicorn, shutil, psutil, requests, base64, re, threading, hashlib, queue
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from urllib.parse import urlparse, unquote
+from requests.adapters import HTTPAdapter
 
 app = FastAPI()
 
 # --- CONFIGURATION ---
 BASE_MODELS_PATH = "/workspace/ComfyUI/models"
 CONFIG_PATH = "/workspace/model-manager/models.json"
+ARIA2_RPC_PORT = int(os.environ.get("ARIA2_RPC_PORT", "6800"))
+# Reprise après redémarrage : session aria2 + journal applicatif des téléchargements
+ARIA2_SESSION_PATH = "/workspace/model-manager/aria2.session"
+DOWNLOAD_JOURNAL_PATH = "/workspace/model-manager/downloads.json"
 
 HF_TOKEN = os.environ.get("HF_TOKEN", "")
 CIVITAI_TOKEN = os.environ.get("CIVITAI_TOKEN", "")
@@ -17,6 +23,33 @@ REPO_OWNER = "rafpi12"
 REPO_NAME = "comfyui"
 GITHUB_FILE_PATH = "model-manager/models.json"
 
+# Sync GitHub : les sauvegardes rapprochées sont regroupées dans cette fenêtre (secondes)
+GITHUB_SYNC_DEBOUNCE = 5
+GITHUB_SYNC_MAX_TRIES = 5
+GITHUB_TIMEOUT = (5, 30)  # (connexion, lecture)
+
+# Planification des téléchargements aria2 : budget par hôte (téléchargements actifs,
+# connexions cumulées) — Civitai nous bride, HF non.
+HOST_PROFILES = {
+    "civitai":     {"max_active": 2, "max_connections": 8},
+    "huggingface": {"max_active": 4, "max_connections": 48},
+    "other":       {"max_active": 2, "max_connections": 16},
+}
+MAX_ACTIVE_DOWNLOADS = int(os.environ.get("MAX_ACTIVE_DOWNLOADS", "6"))
+# Plafond global (syntaxe aria2 : "200M", "0" = illimité) pour ne pas affamer ComfyUI
+# qui charge ses modèles depuis le même volume
+DOWNLOAD_MAX_BANDWIDTH = os.environ.get("DOWNLOAD_MAX_BANDWIDTH", "0")
+SCHEDULER_INTERVAL = 2
+
+# Cache local (disque NVMe du pod) pour les modèles chauds du volume réseau MooseFS
+LOCAL_CACHE_PATH = os.environ.get("LOCAL_CACHE_PATH", "/root/model-cache")
+LOCAL_CACHE_MAX_GB = float(os.environ.get("LOCAL_CACHE_MAX_GB", "150"))
+LOCAL_CACHE_MIN_FREE_GB = float(os.environ.get("LOCAL_CACHE_MIN_FREE_GB", "10"))
+# Prefetch automatique des modèles des derniers prompts ComfyUI (0 = désactivé)
+LOCAL_CACHE_RECENT_INTERVAL = int(os.environ.get("LOCAL_CACHE_RECENT_INTERVAL", "0"))
+COMFYUI_PATH = os.path.dirname(BASE_MODELS_PATH)
+COMFYUI_URL = os.environ.get("COMFYUI_URL", "http://127.0.0.1:8188")
+
 ALLOWED_EXTENSIONS = {'.safetensors', '.pth', '.pt', '.gguf', '.bin', '.ckpt', '.yaml'}
 FOLDER_MODEL_CATEGORIES = {"prompt_generator", "LLM"}
 
@@ -41,6 +74,91 @@ def refresh_dir(path: str):
     except Exception:
         pass
 
+def atomic_write(path: str, raw: bytes):
+    """Écrit via un fichier temporaire + rename : un lecteur ne voit jamais un fichier tronqué."""
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# ── METRICS (format texte Prometheus) ─────────────────────
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Ajoute un en-tête Server-Timing à chaque réponse (désactivé par défaut)
+TIMING_HEADERS = os.environ.get("TIMING_HEADERS", "") == "1"
+
+_metrics_lock = threading.Lock()
+_metric_meta = {}   # nom -> (type, aide)
+_metric_values = {} # (nom, labels triés) -> valeur, ou [compteurs par bucket, somme, total] pour un histogramme
+
+def _labels_key(labels: dict):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name: str, value: float = 1, doc: str = "", **labels):
+    with _metrics_lock:
+        _metric_meta.setdefault(name, ("counter", doc))
+        key = (name, _labels_key(labels))
+        _metric_values[key] = _metric_values.get(key, 0) + value
+
+def set_gauge(name: str, value: float, doc: str = "", **labels):
+    with _metrics_lock:
+        _metric_meta.setdefault(name, ("gauge", doc))
+        _metric_values[(name, _labels_key(labels))] = value
+
+def observe(name: str, value: float, doc: str = "", buckets=LATENCY_BUCKETS, **labels):
+    with _metrics_lock:
+        _metric_meta.setdefault(name, ("histogram", doc))
+        key = (name, _labels_key(labels))
+        h = _metric_values.get(key)
+        if h is None:
+            h = _metric_values[key] = [dict.fromkeys(buckets, 0), 0.0, 0]
+        for b in h[0]:
+            if value <= b:
+                h[0][b] += 1
+        h[1] += value
+        h[2] += 1
+
+def _fmt_labels(pairs) -> str:
+    if not pairs:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        for name, (mtype, help_) in sorted(_metric_meta.items()):
+            if help_:
+                lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} {mtype}")
+            for (n, labels), v in sorted(_metric_values.items()):
+                if n != name:
+                    continue
+                if mtype != "histogram":
+                    lines.append(f"{name}{_fmt_labels(labels)} {v}")
+                    continue
+                for b, count in v[0].items():
+                    lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', str(b)),))} {count}")
+                lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', '+Inf'),))} {v[2]}")
+                lines.append(f"{name}_sum{_fmt_labels(labels)} {v[1]}")
+                lines.append(f"{name}_count{_fmt_labels(labels)} {v[2]}")
+    return "\n".join(lines) + "\n"
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    t0 = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - t0
+    # Libellé = gabarit de route (pas l'URL brute) pour borner la cardinalité
+    route = getattr(request.scope.get("route"), "path", "other")
+    observe("http_request_duration_seconds", elapsed, "Latence des endpoints HTTP",
+            method=request.method, route=route, status=response.status_code)
+    if TIMING_HEADERS:
+        response.headers["Server-Timing"] = f"app;dur={elapsed * 1000:.1f}"
+    return response
+
 # ── RUNPOD QUOTA ──────────────────────────────────────────
 
 def fetch_runpod_quota():
@@ -70,27 +188,311 @@ def fetch_runpod_quota():
 
 def get_client():
     try:
-        client = aria2p.Client(host="http://127.0.0.1", port=6800, secret="")
+        client = aria2p.Client(host="http://127.0.0.1", port=ARIA2_RPC_PORT, secret="")
         api = aria2p.API(client)
         return api
     except: return None
 
+# ── GITHUB SYNC ───────────────────────────────────────────
+
+_github_session = requests.Session()
+_github_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+_github_lock = threading.Lock()          # une seule poussée à la fois
+_github_cond = threading.Condition()     # réveille le worker de sync
+_github_worker = None
+
+github_sync_state = {
+    "status": "idle",        # idle | pending | syncing | ok | skipped | failed | disabled
+    "pending": False,
+    "due_at": None,          # timestamp auquel la poussée différée partira
+    "remote_sha": None,      # sha du blob GitHub connu (évite un GET avant chaque PUT)
+    "last_pushed_hash": None,
+    "last_sync": None,
+    "last_error": "",
+    "attempts": 0,
+}
+
+def _git_blob_sha(content: bytes) -> str:
+    """sha1 calculé comme git (« blob <taille>\0 » + contenu), comparable au sha renvoyé par l'API."""
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+def _github_retry_delay(r, attempt: int) -> float:
+    """Délai avant nouvel essai : Retry-After / X-RateLimit-Reset si fournis, sinon backoff exponentiel."""
+    retry_after = r.headers.get("Retry-After") if r is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), 60)
+    if r is not None and r.headers.get("X-RateLimit-Remaining") == "0":
+        reset = r.headers.get("X-RateLimit-Reset", "")
+        if reset.isdigit():
+            return min(max(int(reset) - time.time(), 1), 60)
+    return min(2 ** attempt, 30)
+
+def _github_is_retryable(r) -> bool:
+    if r.status_code in (409, 429) or r.status_code >= 500:
+        return True
+    # GitHub signale le rate limit secondaire en 403
+    return r.status_code == 403 and (r.headers.get("X-RateLimit-Remaining") == "0" or "Retry-After" in r.headers)
+
 def sync_to_github():
-    if not GITHUB_TOKEN: return False
+    if not GITHUB_TOKEN:
+        github_sync_state.update(status="disabled", last_error="GITHUB_TOKEN absent")
+        return False
     url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/contents/{GITHUB_FILE_PATH}"
     headers = {"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.v3+json"}
+    with _github_lock:
+        github_sync_state["status"] = "syncing"
+        try:
+            with open(CONFIG_PATH, "rb") as f:
+                raw = f.read()
+        except Exception as e:
+            github_sync_state.update(status="failed", last_error=str(e))
+            return False
+        local_hash = _git_blob_sha(raw)
+        if local_hash == github_sync_state["last_pushed_hash"]:
+            github_sync_state.update(status="skipped", last_error="")
+            return True
+        content = base64.b64encode(raw).decode()
+        r = None
+        for attempt in range(GITHUB_SYNC_MAX_TRIES):
+            github_sync_state["attempts"] = attempt + 1
+            try:
+                sha = github_sync_state["remote_sha"]
+                if sha is None:
+                    r = _github_session.get(url, headers=headers, timeout=GITHUB_TIMEOUT)
+                    if r.status_code == 200:
+                        sha = r.json().get("sha")
+                    elif r.status_code != 404 and _github_is_retryable(r):
+                        time.sleep(_github_retry_delay(r, attempt))
+                        continue
+                    if sha == local_hash:
+                        # Contenu identique côté GitHub (ex. après redémarrage) : rien à pousser
+                        github_sync_state.update(status="skipped", remote_sha=sha,
+                                                 last_pushed_hash=local_hash, last_error="")
+                        return True
+                payload = {"message": "Update models.json via Model Manager Pro", "content": content, "sha": sha}
+                r = _github_session.put(url, headers=headers, json=payload, timeout=GITHUB_TIMEOUT)
+                if r.status_code in (200, 201):
+                    new_sha = (r.json().get("content") or {}).get("sha") or local_hash
+                    github_sync_state.update(status="ok", remote_sha=new_sha, last_pushed_hash=local_hash,
+                                             last_sync=time.time(), last_error="")
+                    return True
+                github_sync_state["last_error"] = f"HTTP {r.status_code}"
+                if r.status_code == 409:
+                    # sha obsolète (modifié ailleurs) : on relit le sha distant au prochain essai
+                    github_sync_state["remote_sha"] = None
+                if not _github_is_retryable(r):
+                    break
+            except requests.RequestException as e:
+                r = None
+                github_sync_state["last_error"] = str(e)
+            time.sleep(_github_retry_delay(r, attempt))
+        github_sync_state["status"] = "failed"
+        return False
+
+def _github_sync_loop():
+    while True:
+        with _github_cond:
+            while not github_sync_state["pending"]:
+                _github_cond.wait()
+            # Debounce : tant que de nouvelles sauvegardes repoussent l'échéance, on attend
+            while time.time() < github_sync_state["due_at"]:
+                _github_cond.wait(github_sync_state["due_at"] - time.time())
+            github_sync_state["pending"] = False
+            github_sync_state["due_at"] = None
+        sync_to_github()
+
+def schedule_github_sync():
+    """Planifie une poussée différée ; les appels rapprochés sont fusionnés en une seule."""
+    global _github_worker
+    if not GITHUB_TOKEN:
+        github_sync_state.update(status="disabled", last_error="GITHUB_TOKEN absent")
+        return False
+    with _github_cond:
+        if _github_worker is None or not _github_worker.is_alive():
+            _github_worker = threading.Thread(target=_github_sync_loop, name="github-sync", daemon=True)
+            _github_worker.start()
+        github_sync_state["pending"] = True
+        github_sync_state["status"] = "pending"
+        github_sync_state["due_at"] = time.time() + GITHUB_SYNC_DEBOUNCE
+        _github_cond.notify()
+    return True
+
+# ── CATALOGUE (models.json) ───────────────────────────────
+
+# Champs d'une entrée : les autres clés éventuelles sont conservées telles quelles
+CATALOGUE_FIELDS = ("name", "url", "path", "filename", "category")
+
+catalogue = {
+    "data": {},          # {famille: {catégorie: [entrée, ...]}}
+    "raw": b"{}",        # sérialisation servie par /config
+    "etag": None,
+    "mtime_ns": None,    # détecte une modification externe (git pull, édition manuelle)
+    "by_family": {},     # famille  -> [(famille, catégorie, index)]
+    "by_category": {},   # catégorie -> [...]
+    "by_filename": {},   # filename (minuscules) -> [...]
+}
+
+def _validate_entry(entry, category: str = "") -> dict:
+    """Normalise une entrée du catalogue ; lève ValueError si elle est invalide."""
+    if not isinstance(entry, dict):
+        raise ValueError("entrée invalide (objet attendu)")
+    out = dict(entry)
+    for key in CATALOGUE_FIELDS:
+        val = out.get(key, "")
+        if val is None:
+            val = ""
+        if not isinstance(val, str):
+            raise ValueError(f"champ '{key}' invalide")
+        out[key] = val.strip()
+    if not out["filename"]:
+        raise ValueError("champ 'filename' obligatoire")
+    for key in ("filename", "path"):
+        parts = out[key].replace("\\", "/").split("/")
+        if out[key].startswith("/") or ".." in parts:
+            raise ValueError(f"champ '{key}' : chemin non autorisé")
+    out["name"] = out["name"] or out["filename"]
+    out["category"] = out["category"] or category
+    out["path"] = out["path"] or out["category"]
+    if "_size" in out:
+        try:
+            out["_size"] = int(out["_size"] or 0)
+        except (TypeError, ValueError):
+            out["_size"] = 0
+    return out
+
+def _validate_catalogue(data) -> dict:
+    if not isinstance(data, dict):
+        raise ValueError("catalogue invalide (objet attendu)")
+    clean = {}
+    for family, cats in data.items():
+        if not isinstance(family, str) or not family.strip() or not isinstance(cats, dict):
+            raise ValueError(f"famille invalide : {family!r}")
+        clean[family] = {}
+        for cat, entries in cats.items():
+            if not isinstance(entries, list):
+                raise ValueError(f"{family}/{cat} : liste attendue")
+            clean[family][cat] = [_validate_entry(e, cat) for e in entries]
+    return clean
+
+def _catalogue_reindex():
+    by_family, by_category, by_filename = {}, {}, {}
+    for family, cats in catalogue["data"].items():
+        for cat, entries in cats.items():
+            for i, e in enumerate(entries):
+                ref = (family, cat, i)
+                by_family.setdefault(family, []).append(ref)
+                by_category.setdefault(cat, []).append(ref)
+                by_filename.setdefault(e["filename"].lower(), []).append(ref)
+    catalogue.update(by_family=by_family, by_category=by_category, by_filename=by_filename)
+
+def _catalogue_set(data: dict, raw: bytes, mtime_ns):
+    catalogue.update(data=data, raw=raw, mtime_ns=mtime_ns,
+                     etag='"' + hashlib.sha1(raw).hexdigest() + '"')
+    _catalogue_reindex()
+
+def load_catalogue(force: bool = False):
+    """Charge models.json en mémoire ; ne relit le disque que si le fichier a changé."""
     try:
-        r = requests.get(url, headers=headers)
-        sha = r.json().get('sha') if r.status_code == 200 else None
-        with open(CONFIG_PATH, "rb") as f:
-            content = base64.b64encode(f.read()).decode()
-        payload = {"message": "Update models.json via Model Manager Pro", "content": content, "sha": sha}
-        requests.put(url, headers=headers, json=payload)
-        return True
-    except: return False
+        mtime_ns = os.stat(CONFIG_PATH).st_mtime_ns
+    except OSError:
+        if catalogue["etag"] is None:
+            _catalogue_set({}, b"{}", None)
+        return catalogue
+    if not force and mtime_ns == catalogue["mtime_ns"]:
+        return catalogue
+    with open(CONFIG_PATH, "rb") as f:
+        raw = f.read()
+    try:
+        data = _validate_catalogue(json.loads(raw))
+    except ValueError as e:
+        # Fichier corrompu ou invalide : on garde la dernière version valide en mémoire
+        print(f"⚠️ models.json invalide, ignoré : {e}")
+        catalogue["mtime_ns"] = mtime_ns
+        return catalogue
+    _catalogue_set(data, raw, mtime_ns)
+    return catalogue
+
+def save_catalogue(data: dict):
+    """Écriture atomique puis sync GitHub différée."""
+    raw = json.dumps(data, indent=4).encode("utf-8")
+    atomic_write(CONFIG_PATH, raw)
+    _catalogue_set(data, raw, os.stat(CONFIG_PATH).st_mtime_ns)
+    return schedule_github_sync()
+
+def catalogue_lookup(family: str = "", category: str = "", filename: str = ""):
+    refs = None
+    for index, key in (("by_family", family), ("by_category", category), ("by_filename", filename.lower())):
+        if not key:
+            continue
+        found = set(catalogue[index].get(key, []))
+        refs = found if refs is None else refs & found
+    if refs is None:
+        refs = {ref for refs_ in catalogue["by_family"].values() for ref in refs_}
+    return [{**catalogue["data"][f][c][i], "family": f, "category": c, "index": i} for f, c, i in sorted(refs)]
+
+def _find_on_disk(entry: dict, disk: dict):
+    """Même règle que l'UI : catégorie = 1er segment de path, filename exact ou suffixe '/filename'."""
+    disk_key = entry["path"].split("/")[0]
+    wanted = entry["filename"].lower()
+    for f in disk.get(disk_key, []):
+        p = f["path"].lower()
+        if p == wanted or p.endswith("/" + wanted):
+            return f
+    return None
+
+def _catalogue_response(request: Request, status_code: int = 200):
+    headers = {"ETag": catalogue["etag"], "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == catalogue["etag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=catalogue["raw"], media_type="application/json",
+                    status_code=status_code, headers=headers)
+
+def _catalogue_error(msg: str, status_code: int = 400):
+    return JSONResponse({"status": "error", "message": msg}, status_code=status_code)
+
+def scan_models_dir():
+    """Index disque : {catégorie: [{path, size[, is_folder]}]} sous BASE_MODELS_PATH."""
+    t0 = time.perf_counter()
+    res = {}
+    if os.path.exists(BASE_MODELS_PATH):
+        refresh_dir(BASE_MODELS_PATH)  # flush racine models avant de scanner
+        for entry in os.scandir(BASE_MODELS_PATH):
+            if entry.is_dir():
+                cat_name = entry.name
+                refresh_dir(entry.path)  # flush chaque catégorie
+                if cat_name in FOLDER_MODEL_CATEGORIES:
+                    folders = []
+                    for sub in os.scandir(entry.path):
+                        if sub.is_dir():
+                            refresh_dir(sub.path)
+                            total_size = 0
+                            for root, _, filenames in os.walk(sub.path):
+                                refresh_dir(root)
+                                for f in filenames:
+                                    try:
+                                        total_size += os.path.getsize(os.path.join(root, f))
+                                    except:
+                                        pass
+                            folders.append({"path": sub.name, "size": total_size, "is_folder": True})
+                    res[cat_name] = folders
+                else:
+                    files = []
+                    for root, dirs, filenames in os.walk(entry.path):
+                        refresh_dir(root)  # flush chaque sous-dossier parcouru
+                        for f in filenames:
+                            if any(f.endswith(ext) for ext in ALLOWED_EXTENSIONS):
+                                rel_path = os.path.relpath(os.path.join(root, f), entry.path)
+                                full_path = os.path.join(root, f)
+                                size = os.path.getsize(full_path)
+                                files.append({"path": rel_path.replace("\\", "/"), "size": size})
+                    res[cat_name] = files
+    record_dir_scan("scan-disk", t0, sum(len(v) for v in res.values()))
+    return res
 
 @app.get("/list-subfolders")
 async def list_subfolders(category: str):
+    t0 = time.perf_counter()
     base = os.path.join(BASE_MODELS_PATH, category)
     subdirs = [""]
     if os.path.exists(base):
@@ -100,6 +502,7 @@ async def list_subfolders(category: str):
             for d in dirs:
                 rel = os.path.relpath(os.path.join(root, d), base)
                 subdirs.append(rel.replace("\\", "/"))
+    record_dir_scan("list-subfolders", t0, len(subdirs))
     return sorted(list(set(subdirs)))
 
 @app.get("/fetch-civitai-name")
@@ -183,124 +586,464 @@ async def index():
     return "Fichier index.html introuvable."
 
 @app.get("/config")
-async def get_config():
-    if os.path.exists(CONFIG_PATH):
-        with open(CONFIG_PATH, 'r', encoding='utf-8') as f: return json.load(f)
-    return {}
+async def get_config(request: Request):
+    load_catalogue()
+    return _catalogue_response(request)
 
 @app.post("/save-config")
 async def save_config(request: Request):
+    try:
+        data = _validate_catalogue(await request.json())
+    except ValueError as e:
+        return _catalogue_error(str(e))
+    queued = save_catalogue(data)
+    return {"status": "ok", "github_sync": "queued" if queued else "disabled", "etag": catalogue["etag"]}
+
+@app.get("/catalogue/lookup")
+async def catalogue_lookup_endpoint(family: str = "", category: str = "", filename: str = ""):
+    load_catalogue()
+    return catalogue_lookup(family, category, filename)
+
+@app.get("/catalogue/status")
+async def catalogue_status(family: str = "", include_disk: bool = False):
+    """
+    Jointure catalogue × disque : installed / missing / taille, calculée côté serveur.
+    include_disk=1 renvoie aussi l'index disque ({"status": [...], "disk": {...}}) : l'UI n'a
+    alors besoin que d'un seul parcours du volume par rafraîchissement.
+    """
+    load_catalogue()
+    disk = await run_in_threadpool(scan_models_dir)
+    res = []
+    for item in catalogue_lookup(family=family):
+        found = _find_on_disk(item, disk)
+        res.append({
+            "family": item["family"], "category": item["category"], "filename": item["filename"],
+            "status": "installed" if found and found.get("size") else "missing",
+            "size": found["size"] if found else 0,
+            "disk_path": found["path"] if found else item["filename"],
+        })
+    return {"status": res, "disk": disk} if include_disk else res
+
+@app.post("/catalogue/entry")
+async def catalogue_put_entry(request: Request):
+    """Ajoute une entrée (ou remplace celle qui a le même filename dans famille/catégorie)."""
+    data = await request.json()
+    family, category = (data.get("family") or "").strip(), (data.get("category") or "").strip()
+    if not family or not category:
+        return _catalogue_error("famille et catégorie obligatoires")
+    try:
+        entry = _validate_entry(data.get("entry"), category)
+    except ValueError as e:
+        return _catalogue_error(str(e))
+    load_catalogue()
+    if request.headers.get("if-match") not in (None, catalogue["etag"]):
+        return _catalogue_error("catalogue modifié entre-temps, recharger", 412)
+    new = {f: {c: list(es) for c, es in cats.items()} for f, cats in catalogue["data"].items()}
+    entries = new.setdefault(family, {}).setdefault(category, [])
+    idx = next((i for i, e in enumerate(entries) if e["filename"] == entry["filename"]), -1)
+    if idx > -1:
+        entries[idx] = entry
+    else:
+        entries.append(entry)
+    queued = save_catalogue(new)
+    return {"status": "ok", "created": idx == -1, "github_sync": "queued" if queued else "disabled",
+            "etag": catalogue["etag"]}
+
+@app.patch("/catalogue/entry")
+async def catalogue_patch_entry(request: Request):
+    """Met à jour certains champs d'une entrée existante (identifiée par famille/catégorie/filename)."""
     data = await request.json()
-    with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4)
-    github_synced = sync_to_github()
-    return {"status": "ok", "github_sync": "ok" if github_synced else "failed"}
+    family, category, filename = data.get("family", ""), data.get("category", ""), data.get("filename", "")
+    changes = data.get("changes") or {}
+    load_catalogue()
+    if request.headers.get("if-match") not in (None, catalogue["etag"]):
+        return _catalogue_error("catalogue modifié entre-temps, recharger", 412)
+    entries = catalogue["data"].get(family, {}).get(category)
+    idx = next((i for i, e in enumerate(entries or []) if e["filename"] == filename), -1)
+    if idx == -1:
+        return _catalogue_error("entrée introuvable", 404)
+    try:
+        entry = _validate_entry({**entries[idx], **changes}, category)
+    except ValueError as e:
+        return _catalogue_error(str(e))
+    new = {f: {c: list(es) for c, es in cats.items()} for f, cats in catalogue["data"].items()}
+    new[family][category][idx] = entry
+    queued = save_catalogue(new)
+    return {"status": "ok", "github_sync": "queued" if queued else "disabled", "etag": catalogue["etag"]}
+
+@app.delete("/catalogue/entry")
+async def catalogue_delete_entry(request: Request, family: str, category: str, filename: str):
+    load_catalogue()
+    if request.headers.get("if-match") not in (None, catalogue["etag"]):
+        return _catalogue_error("catalogue modifié entre-temps, recharger", 412)
+    entries = catalogue["data"].get(family, {}).get(category)
+    idx = next((i for i, e in enumerate(entries or []) if e["filename"] == filename), -1)
+    if idx == -1:
+        return _catalogue_error("entrée introuvable", 404)
+    new = {f: {c: list(es) for c, es in cats.items()} for f, cats in catalogue["data"].items()}
+    del new[family][category][idx]
+    queued = save_catalogue(new)
+    return {"status": "ok", "github_sync": "queued" if queued else "disabled", "etag": catalogue["etag"]}
 
 @app.post("/sync-github")
 async def sync_github_endpoint():
-    result = sync_to_github()
+    # Sync manuelle immédiate ; le worker de fond continue de gérer les sauvegardes différées
+    result = await run_in_threadpool(sync_to_github)
     if result:
-        return {"status": "ok"}
-    return {"status": "error", "message": "Sync échoué — vérifier GITHUB_TOKEN"}
+        return {"status": "ok", "github_sync": github_sync_state["status"]}
+    return {"status": "error", "message": f"Sync échoué — vérifier GITHUB_TOKEN ({github_sync_state['last_error']})"}
+
+@app.get("/sync-status")
+async def sync_status():
+    st = dict(github_sync_state)
+    st["due_in"] = round(max(st.pop("due_at") - time.time(), 0), 1) if st.get("due_at") else None
+    return st
 
 @app.get("/scan-disk")
 async def scan_disk():
-    res = {}
-    if os.path.exists(BASE_MODELS_PATH):
-        refresh_dir(BASE_MODELS_PATH)  # flush racine models avant de scanner
-        for entry in os.scandir(BASE_MODELS_PATH):
-            if entry.is_dir():
-                cat_name = entry.name
-                refresh_dir(entry.path)  # flush chaque catégorie
-                if cat_name in FOLDER_MODEL_CATEGORIES:
-                    folders = []
-                    for sub in os.scandir(entry.path):
-                        if sub.is_dir():
-                            refresh_dir(sub.path)
-                            total_size = 0
-                            for root, _, filenames in os.walk(sub.path):
-                                refresh_dir(root)
-                                for f in filenames:
-                                    try:
-                                        total_size += os.path.getsize(os.path.join(root, f))
-                                    except:
-                                        pass
-                            folders.append({"path": sub.name, "size": total_size, "is_folder": True})
-                    res[cat_name] = folders
-                else:
-                    files = []
-                    for root, dirs, filenames in os.walk(entry.path):
-                        refresh_dir(root)  # flush chaque sous-dossier parcouru
-                        for f in filenames:
-                            if any(f.endswith(ext) for ext in ALLOWED_EXTENSIONS):
-                                rel_path = os.path.relpath(os.path.join(root, f), entry.path)
-                                full_path = os.path.join(root, f)
-                                size = os.path.getsize(full_path)
-                                files.append({"path": rel_path.replace("\\", "/"), "size": size})
-                    res[cat_name] = files
-    return res
+    return await run_in_threadpool(scan_models_dir)
 
-@app.post("/download")
-async def download(request: Request):
+# ── DOWNLOAD SCHEDULER ────────────────────────────────────
+# Chaque téléchargement est ajouté en pause dans aria2 ; le scheduler le relance quand
+# le budget de son hôte le permet, par priorité décroissante puis taille croissante.
+
+download_jobs = {}      # gid -> {dest, host, priority, size, added, filename, connections}
+_scheduler_lock = threading.Lock()
+_scheduler_worker = None
+scheduler_state = {"bandwidth": DOWNLOAD_MAX_BANDWIDTH, "applied_bandwidth": None, "last_tick": None, "last_error": ""}
+
+# Journal : dest -> requête d'origine (url, path, filename, priority, size). Les téléchargements
+# qui y figurent sont ré-attachés ou ré-ajoutés au démarrage ; aria2 reprend via le fichier .aria2.
+_journal_lock = threading.Lock()
+download_journal = {}
+_journal_restored = False
+
+def load_journal():
+    global download_journal
+    try:
+        with open(DOWNLOAD_JOURNAL_PATH, "r", encoding="utf-8") as f:
+            download_journal = json.load(f)
+    except (OSError, ValueError):
+        download_journal = {}
+
+def _save_journal():
+    try:
+        atomic_write(DOWNLOAD_JOURNAL_PATH, json.dumps(download_journal, indent=2).encode("utf-8"))
+    except OSError as e:
+        print(f"⚠️ Journal des téléchargements non écrit : {e}")
+
+def journal_add(dest: str, entry: dict):
+    with _journal_lock:
+        download_journal[dest] = entry
+        _save_journal()
+
+def journal_remove(*dests):
+    with _journal_lock:
+        if any([download_journal.pop(d, None) is not None for d in dests]):
+            _save_journal()
+
+def _download_dest(d) -> str:
+    try:
+        path = d.files[0].path  # pathlib.Path côté aria2p, "." tant que le nom n'est pas connu
+        return str(path) if path and str(path) != "." else ""
+    except Exception:
+        return ""
+
+def _job_from_entry(dest: str, entry: dict) -> dict:
+    size = int(entry.get("size") or 0)
+    return {"dest": dest, "host": _host_class(entry.get("url")), "priority": int(entry.get("priority", 0)),
+            "size": size, "added": entry.get("added", time.time()), "filename": entry.get("filename"),
+            "connections": _split_for_size(size)}
+
+def restore_downloads(client=None) -> bool:
+    """
+    Ré-attache les jobs journalisés à la session aria2 restaurée, ré-ajoute ceux qui manquent.
+    Appelée par schedule_downloads avec _scheduler_lock déjà pris (verrou non réentrant) :
+    elle passe donc par _add_download et remplit download_jobs elle-même.
+    """
+    global _journal_restored
+    client = client or get_client()
+    try:
+        downloads = client.get_downloads()
+    except Exception:
+        return False  # aria2 pas encore prêt, on réessaiera au prochain tour
+    by_dest = {_download_dest(d): d for d in downloads if d.status not in ("complete", "removed", "error")}
+    for dest, entry in list(download_journal.items()):
+        d = by_dest.get(dest)
+        if d is not None:
+            download_jobs[d.gid] = _job_from_entry(dest, entry)
+            continue
+        if os.path.exists(dest) and not os.path.exists(dest + ".aria2"):
+            journal_remove(dest)  # terminé pendant l'arrêt du manager
+            continue
+        try:
+            gid, added_dest, added_entry = _add_download(client, entry)
+            download_jobs[gid] = _job_from_entry(added_dest, added_entry)
+            print(f"🔁 Reprise : {entry.get('filename')}")
+        except Exception as e:
+            print(f"⚠️ Reprise impossible pour {dest} : {e}")
+    _journal_restored = True
+    return True
+
+def _host_class(url: str) -> str:
+    u = (url or "").lower()
+    if "civitai.com" in u or "civitai.red" in u:
+        return "civitai"
+    if "huggingface.co" in u:
+        return "huggingface"
+    return "other"
+
+def _split_for_size(size: int) -> int:
+    """Nombre de segments adapté à la taille : inutile d'ouvrir 16 connexions pour un LoRA de 50 Mo."""
+    MB = 1_048_576
+    if size <= 0:
+        return 8          # taille inconnue
+    if size < 64 * MB:
+        return 1
+    if size < 512 * MB:
+        return 4
+    if size < 4096 * MB:
+        return 8
+    return 16
+
+def _probe_size(url: str, headers: list) -> int:
+    try:
+        hdr = dict(h.split(": ", 1) for h in headers)
+        r = requests.head(url, headers=hdr, allow_redirects=True, timeout=5)
+        return int(r.headers.get("Content-Length", 0) or 0)
+    except Exception:
+        return 0
+
+def _job_order(gid: str, jobs=None):
+    job = (download_jobs if jobs is None else jobs)[gid]
+    return (-job["priority"], job["size"] or float("inf"), job["added"])
+
+def schedule_downloads(client=None):
+    """Un tour de planification : relance les jobs en attente dans la limite des budgets."""
+    global _journal_restored
+    client = client or get_client()
+    if not client:
+        return
+    with _scheduler_lock:
+        try:
+            if scheduler_state["applied_bandwidth"] != scheduler_state["bandwidth"]:
+                client.client.change_global_option({"max-overall-download-limit": scheduler_state["bandwidth"]})
+                scheduler_state["applied_bandwidth"] = scheduler_state["bandwidth"]
+            if not _journal_restored:
+                restore_downloads(client)
+            status = {d.gid: d.status for d in client.get_downloads()}
+            for gid in [g for g in download_jobs if g not in status or status[g] in ("complete", "removed", "error")]:
+                job = download_jobs.pop(gid)
+                st = status.get(gid)
+                if st in ("complete", "removed") or (os.path.exists(job["dest"]) and not os.path.exists(job["dest"] + ".aria2")):
+                    journal_remove(job["dest"])  # terminé, ou retiré volontairement d'aria2
+                elif st is None:
+                    # Gid disparu : aria2 redémarré sans session (crash, pkill du captioner…). On garde
+                    # le journal et on relance la restauration au prochain tour, via le fichier .aria2
+                    _journal_restored = False
+                # "error" : reste au journal, retenté à la prochaine restauration
+            running = [g for g, st in status.items() if st in ("active", "waiting")]
+            used_active = {h: 0 for h in HOST_PROFILES}
+            used_conn = {h: 0 for h in HOST_PROFILES}
+            for g in running:
+                job = download_jobs.get(g)
+                if job:
+                    used_active[job["host"]] += 1
+                    used_conn[job["host"]] += job["connections"]
+            slots = MAX_ACTIVE_DOWNLOADS - len(running)
+            queued = sorted((g for g in download_jobs if status.get(g) == "paused" and not download_jobs[g].get("held")),
+                            key=_job_order)
+            for gid in queued:
+                if slots <= 0:
+                    break
+                job = download_jobs[gid]
+                prof = HOST_PROFILES[job["host"]]
+                free_conn = prof["max_connections"] - used_conn[job["host"]]
+                if used_active[job["host"]] >= prof["max_active"] or free_conn <= 0:
+                    continue
+                conns = max(1, min(_split_for_size(job["size"]), free_conn))
+                client.client.change_option(gid, {"split": str(conns), "max-connection-per-server": str(conns)})
+                client.client.unpause(gid)
+                job["connections"] = conns
+                used_active[job["host"]] += 1
+                used_conn[job["host"]] += conns
+                slots -= 1
+            scheduler_state.update(last_tick=time.time(), last_error="")
+        except Exception as e:
+            scheduler_state["last_error"] = str(e)
+
+def _scheduler_loop():
+    load_journal()
+    while True:
+        schedule_downloads()
+        time.sleep(SCHEDULER_INTERVAL)
+
+def ensure_scheduler():
+    global _scheduler_worker
+    if _scheduler_worker is None or not _scheduler_worker.is_alive():
+        _scheduler_worker = threading.Thread(target=_scheduler_loop, name="download-scheduler", daemon=True)
+        _scheduler_worker.start()
+
+@app.on_event("startup")
+async def startup():
+    ensure_scheduler()
+    _cache_load_index()
+    # ComfyUI ne lit extra_model_paths qu'au démarrage : le fichier doit exister avant le premier préchauffage
+    try:
+        os.makedirs(LOCAL_CACHE_PATH, exist_ok=True)
+        write_extra_model_paths()
+    except OSError as e:
+        cache_state["last_error"] = f"extra_model_paths : {e}"
+    ensure_cache_worker()  # rapatriement des installations tombées dans le cache, prefetch éventuel
+
+@app.get("/scheduler")
+async def scheduler_status():
+    jobs = dict(download_jobs)  # instantané : le thread du scheduler modifie la table
+    return {**scheduler_state, "host_profiles": HOST_PROFILES, "max_active": MAX_ACTIVE_DOWNLOADS,
+            "queue": [{"gid": g, **jobs[g]} for g in sorted(jobs, key=lambda g: _job_order(g, jobs))]}
+
+@app.post("/scheduler/bandwidth")
+async def scheduler_bandwidth(request: Request):
     data = await request.json()
-    url, category, filename = data.get("url"), data.get("path"), data.get("filename")
-    clean_cat = category.replace(BASE_MODELS_PATH, "").lstrip("/")
-    target_dir = os.path.join(BASE_MODELS_PATH, clean_cat)
-    os.makedirs(target_dir, exist_ok=True)
+    limit = str(data.get("limit", "0")).strip()
+    if not re.fullmatch(r"\d+[KkMm]?", limit):
+        return JSONResponse({"status": "error", "message": "Limite invalide (ex. 200M, 0 = illimité)"}, status_code=400)
+    scheduler_state["bandwidth"] = limit
+    await run_in_threadpool(schedule_downloads)
+    return {"status": "ok", "bandwidth": limit}
 
+@app.post("/download/priority")
+async def download_priority(request: Request):
+    """Change la priorité d'un job ; reflétée dans la file aria2 via changePosition."""
+    data = await request.json()
+    gid = data.get("gid")
+    if gid not in download_jobs:
+        return JSONResponse({"status": "error", "message": "Téléchargement inconnu"}, status_code=404)
+    try:
+        priority = int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        return JSONResponse({"status": "error", "message": "Priorité invalide"}, status_code=400)
     client = get_client()
     if not client: return {"status": "error", "message": "Aria2 non connecté"}
+    await run_in_threadpool(reprioritize, client, gid, priority, bool(data["held"]) if "held" in data else None)
+    await run_in_threadpool(schedule_downloads, client)
+    return {"status": "ok"}
 
-    # Nettoyage préventif
-    dest = os.path.join(target_dir, filename)
-    if os.path.exists(dest + ".aria2"): os.remove(dest + ".aria2")
+def reprioritize(client, gid: str, priority: int, held=None):
+    """Met à jour le job puis réordonne la file d'attente aria2 (waiting / paused uniquement)."""
+    with _scheduler_lock:
+        job = download_jobs.get(gid)
+        if not job:
+            return
+        job["priority"] = priority
+        if held is not None:
+            job["held"] = held
+        if job["dest"] in download_journal:
+            journal_add(job["dest"], {**download_journal[job["dest"]], "priority": priority})
+        try:
+            waiting = {d["gid"] for d in client.client.tell_waiting(0, 1000, ["gid"])}
+        except Exception:
+            return
+        # Les téléchargements actifs n'ont pas de position : on ne place que ceux de la file
+        for pos, g in enumerate(g for g in sorted(download_jobs, key=_job_order) if g in waiting):
+            try:
+                client.client.change_position(g, pos, "POS_SET")
+            except Exception:
+                continue  # passé actif ou terminé entre-temps
 
-    is_civitai = "civitai.com" in url.lower() or "civitai.red" in url.lower()
-    is_hf = "huggingface.co" in url.lower()
+@app.post("/download/options")
+async def download_options(request: Request):
+    """Relaie changeOption (ex. max-download-limit, split) pour un téléchargement."""
+    data = await request.json()
+    gid, options = data.get("gid"), data.get("options") or {}
+    client = get_client()
+    if not client: return {"status": "error", "message": "Aria2 non connecté"}
+    split = None
+    if "split" in options:
+        try:
+            split = int(options["split"])
+        except (TypeError, ValueError):
+            return JSONResponse({"status": "error", "message": "split doit être un entier"}, status_code=400)
+    try:
+        client.client.change_option(gid, {k: str(v) for k, v in options.items()})
+        if split is not None:
+            with _scheduler_lock:
+                if gid in download_jobs:
+                    download_jobs[gid]["connections"] = split
+        return {"status": "ok"}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
 
+def _resolve_download(url: str):
+    """URL finale et en-têtes aria2 selon l'hôte (redirection Civitai signée, token HF)."""
     headers = [
         "User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
         "(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
     ]
-
     final_url = url
+    host = _host_class(url)
 
-    if is_civitai:
+    if host == "civitai":
+        resolve_headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                          "(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+            "Authorization": f"Bearer {CIVITAI_TOKEN}"
+        }
         try:
-            resolve_headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-                              "(KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-                "Authorization": f"Bearer {CIVITAI_TOKEN}"
-            }
             r = requests.get(url, headers=resolve_headers, allow_redirects=False, timeout=10)
-            if r.status_code in (301, 302, 307, 308) and "location" in r.headers:
-                final_url = r.headers["location"]
-            elif r.status_code != 200:
-                sep = "&" if "?" in url else "?"
-                final_url = f"{url}{sep}token={CIVITAI_TOKEN}"
         except Exception as e:
-            return {"status": "error", "message": f"Impossible de résoudre l'URL Civitai : {e}"}
+            raise RuntimeError(f"Impossible de résoudre l'URL Civitai : {e}")
+        if r.status_code in (301, 302, 307, 308) and "location" in r.headers:
+            final_url = r.headers["location"]
+        elif r.status_code != 200:
+            sep = "&" if "?" in url else "?"
+            final_url = f"{url}{sep}token={CIVITAI_TOKEN}"
 
-        connections = "16"
-        split = "16"
-
-    elif is_hf:
+    elif host == "huggingface":
         if HF_TOKEN:
             headers.append(f"Authorization: Bearer {HF_TOKEN}")
-        connections = "16"
-        split = "16"
-    else:
-        connections = "16"
-        split = "16"
+
+    return final_url, headers
+
+def submit_download(client, req: dict) -> str:
+    """
+    Ajoute un téléchargement (en pause, démarré par le scheduler) et le journalise.
+    Par défaut un fichier partiel est repris via son fichier de contrôle .aria2 ;
+    req["restart"] force un redémarrage de zéro.
+    """
+    gid, dest, entry = _add_download(client, req)
+    with _scheduler_lock:
+        download_jobs[gid] = _job_from_entry(dest, entry)
+    return gid
+
+def _add_download(client, req: dict):
+    """Ajout aria2 + journal, sans toucher download_jobs ni _scheduler_lock ; renvoie (gid, dest, entry)."""
+    url, category, filename = req.get("url"), req.get("path"), req.get("filename")
+    clean_cat = category.replace(BASE_MODELS_PATH, "").lstrip("/")
+    target_dir = os.path.join(BASE_MODELS_PATH, clean_cat)
+    os.makedirs(target_dir, exist_ok=True)
+    dest = os.path.join(target_dir, filename)
+
+    restart = bool(req.get("restart"))
+    if restart:
+        for p in (dest + ".aria2", dest):
+            if os.path.exists(p): os.remove(p)
+
+    final_url, headers = _resolve_download(url)
+
+    # La taille sert au choix du nombre de segments et à l'ordre de passage
+    size = int(req.get("size") or 0) or _probe_size(final_url, headers)
+    connections = str(_split_for_size(size))
 
     options = {
         "dir": target_dir,
         "out": filename,
         "continue": "true",
-        "allow-overwrite": "true",
+        # Sans écrasement, aria2 reprend depuis le .aria2 au lieu de repartir de zéro
+        "allow-overwrite": "true" if restart else "false",
         "auto-file-renaming": "false",
         "max-connection-per-server": connections,
-        "split": split,
+        "split": connections,
         "min-split-size": "5M",
         "piece-length": "1M",
         "header": headers,
@@ -308,11 +1051,25 @@ async def download(request: Request):
         "max-tries": "5",
         "retry-wait": "3",
         "stream-piece-selector": "geom",
+        # Ajouté en pause : c'est le scheduler qui le démarre selon les budgets
+        "pause": "true",
     }
 
+    dl = client.add_uris([final_url], options=options)
+    entry = {"url": url, "path": clean_cat, "filename": filename, "size": size,
+             "priority": int(req.get("priority", 0)), "added": time.time()}
+    journal_add(dest, entry)
+    return dl.gid, dest, entry
+
+@app.post("/download")
+async def download(request: Request):
+    data = await request.json()
+    client = get_client()
+    if not client: return {"status": "error", "message": "Aria2 non connecté"}
     try:
-        client.add(final_url, options=options)
-        return {"status": "ok"}
+        gid = await run_in_threadpool(submit_download, client, data)
+        await run_in_threadpool(schedule_downloads, client)
+        return {"status": "ok", "gid": gid}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -338,6 +1095,9 @@ async def progress():
                     name = "Initialisation..."
 
             status = d.status
+            job = download_jobs.get(d.gid)
+            if status == "paused" and job and not job.get("held"):
+                status = "queued"  # en attente d'un créneau du scheduler
             if status == "error":
                 status = f"Erreur (Code {d.error_code})"
 
@@ -372,6 +1132,8 @@ async def progress():
                 "speed": speed_str,
                 "eta": eta_str,
                 "gid": d.gid,
+                "priority": job["priority"] if job else None,
+                "host": job["host"] if job else None,
             })
         return res
     except: return []
@@ -385,16 +1147,20 @@ def filename_fallback(download):
 @app.get("/disk-usage")
 async def disk_usage():
     try:
-        used_bytes = 0
+        t0 = time.perf_counter()
+        used_bytes, n_files = 0, 0
         if os.path.exists(BASE_MODELS_PATH):
             for root, _, files in os.walk(BASE_MODELS_PATH):
                 refresh_dir(root)  # flush chaque dossier pendant le calcul
+                n_files += len(files)
                 for f in files:
                     try:
                         used_bytes += os.path.getsize(os.path.join(root, f))
                     except:
                         pass
 
+        record_dir_scan("disk-usage", t0, n_files)
+
         GB = 1_073_741_824
         used_gb = round(used_bytes / GB, 2)
         total_gb = fetch_runpod_quota()
@@ -418,6 +1184,376 @@ async def disk_usage():
     except Exception as e:
         return {"workspace": None, "error": str(e)}
 
+# ── CACHE LOCAL (NVMe) ────────────────────────────────────
+# Copie les modèles chauds du volume réseau vers LOCAL_CACHE_PATH (même arborescence).
+# ComfyUI les y cherche en premier via extra_model_paths (is_default: true) ; un fichier
+# absent du cache (autre pod, éviction) est simplement relu depuis le volume réseau.
+# Contrepartie : ComfyUI cherche dans l'ordre des dossiers, et le premier est aussi celui où
+# s'installent les nouveaux modèles (ComfyUI-Manager…). Impossible d'avoir l'un sans l'autre :
+# on ne déclare donc que les catégories déjà mises en cache, et les fichiers étrangers
+# déposés dans le cache sont rapatriés sur le volume (cache_adopt_strays).
+
+CACHE_MARKER = "# Généré par Model Manager Pro (cache local) — ne pas éditer"
+CACHE_FINGERPRINT_CHUNK = 4 * 1_048_576
+CACHE_STRAY_AGE = 600  # s sans écriture avant de rapatrier un fichier inconnu de l'index
+CACHE_INDEX_PATH = os.path.join(LOCAL_CACHE_PATH, ".index.json")
+
+cache_index = {}        # "catégorie/chemin" -> {size, src_mtime_ns, fingerprint, cached_at, last_used}
+_cache_lock = threading.RLock()
+_cache_queue = queue.Queue()
+_cache_worker = None
+cache_state = {"copying": None, "pending": [], "last_error": "", "extra_paths_file": None,
+               "extra_paths_issue": None, "extra_paths_message": ""}
+
+def cache_rel(rel):
+    """
+    Normalise un chemin "catégorie/chemin" ; None s'il est absolu ou s'il sort de BASE_MODELS_PATH
+    (source) ou de LOCAL_CACHE_PATH (copie). Tout ce qui est copié ou supprimé passe par ici.
+    """
+    if not isinstance(rel, str) or not rel or os.path.isabs(rel):
+        return None
+    rel = os.path.normpath(rel)
+    if rel in (".", "..") or rel.startswith(".." + os.sep) or os.path.isabs(rel):
+        return None
+    for root in (BASE_MODELS_PATH, LOCAL_CACHE_PATH):
+        real_root = os.path.realpath(root)
+        if os.path.commonpath([real_root, os.path.realpath(os.path.join(real_root, rel))]) != real_root:
+            return None
+    return rel
+
+def _fingerprint(path: str, size: int) -> str:
+    """Empreinte rapide : taille + sha256 de 3 blocs (début, milieu, fin), sans relire 20 Go."""
+    h = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        for off in (0, max(0, size // 2 - CACHE_FINGERPRINT_CHUNK // 2), max(0, size - CACHE_FINGERPRINT_CHUNK)):
+            f.seek(off)
+            h.update(f.read(CACHE_FINGERPRINT_CHUNK))
+    return h.hexdigest()
+
+def _cache_load_index():
+    global cache_index
+    try:
+        with open(CACHE_INDEX_PATH, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    # Le disque local est éphémère : on oublie ce qui n'existe plus
+    cache_index = {rel: e for rel, e in index.items()
+                   if cache_rel(rel) == rel and os.path.exists(os.path.join(LOCAL_CACHE_PATH, rel))}
+
+def _cache_save_index():
+    atomic_write(CACHE_INDEX_PATH, json.dumps(cache_index, indent=2).encode("utf-8"))
+
+def write_extra_model_paths():
+    """
+    Déclare LOCAL_CACHE_PATH à ComfyUI pour les catégories qui ont déjà eu un fichier en cache
+    (celles du fichier existant + les dossiers du cache) : les autres gardent le volume réseau
+    comme premier dossier, donc comme cible des installations. La liste ne fait que grandir,
+    d'un pod à l'autre : une nouvelle catégorie demande un redémarrage de ComfyUI, une seule fois.
+    N'écrase jamais un extra_model_paths.yaml écrit à la main : on écrit alors un fichier
+    séparé, à passer à ComfyUI via --extra-model-paths-config.
+    """
+    target = os.path.join(COMFYUI_PATH, "extra_model_paths.yaml")
+    current = ""
+    for path in (target, os.path.join(COMFYUI_PATH, "extra_model_paths_cache.yaml")):
+        try:
+            with open(path, encoding="utf-8") as f:
+                current = f.read()
+        except OSError:
+            current = ""
+        if path == target and current and not current.startswith(CACHE_MARKER):
+            continue  # fichier écrit à la main : on écrit à côté
+        target = path
+        break
+    declared = set(re.findall(r"^    ([^:\s]+): \1/$", current, re.M))
+    cached = {e.name for e in os.scandir(LOCAL_CACHE_PATH) if e.is_dir() and not e.name.startswith(".")}
+    cats = sorted(c for c in declared | cached if os.path.isdir(os.path.join(BASE_MODELS_PATH, c)))
+    body = f"{CACHE_MARKER}\nmodel_manager_local_cache:\n    base_path: {LOCAL_CACHE_PATH}\n    is_default: true\n"
+    body += "".join(f"    {c}: {c}/\n" for c in cats)
+    unchanged = current == body
+    if not unchanged:  # ne pas toucher le mtime : il sert à détecter un ComfyUI à redémarrer
+        atomic_write(target, body.encode("utf-8"))
+    cache_state["extra_paths_file"] = target
+    check_extra_model_paths()
+
+def comfyui_process():
+    """(cmdline, heure de démarrage) du ComfyUI lancé depuis COMFYUI_PATH, ou None."""
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmd = [a.decode(errors="replace") for a in f.read().split(b"\0") if a]
+            if not any(os.path.basename(a) == "main.py" for a in cmd):
+                continue
+            if os.path.realpath(os.readlink(f"/proc/{pid}/cwd")) != os.path.realpath(COMFYUI_PATH):
+                continue
+            return cmd, os.stat(f"/proc/{pid}").st_mtime
+        except OSError:
+            continue
+    return None
+
+def check_extra_model_paths():
+    """ComfyUI ne lit extra_model_paths qu'au démarrage : signale un fichier non branché ou trop récent."""
+    target = cache_state["extra_paths_file"]
+    issue, message = None, ""
+    proc = comfyui_process() if target else None
+    if target and os.path.basename(target) != "extra_model_paths.yaml":
+        if not proc or target not in proc[0]:
+            issue = "not_wired"
+            message = f"Cache local ignoré par ComfyUI : relancer ComfyUI avec --extra-model-paths-config {target}"
+    if not issue and proc and os.path.getmtime(target) > proc[1]:
+        issue = "restart_required"
+        message = "Cache local déclaré après le démarrage de ComfyUI : redémarrer ComfyUI pour l'utiliser"
+    cache_state["extra_paths_issue"], cache_state["extra_paths_message"] = issue, message
+
+def cache_adopt_strays() -> list:
+    """
+    Rapatrie sur le volume réseau les fichiers du cache inconnus de l'index : un modèle installé
+    depuis ComfyUI dans une catégorie déclarée atterrit ici (premier dossier) et disparaîtrait
+    avec le pod. Une copie orpheline d'un fichier déjà présent sur le volume est supprimée.
+    """
+    adopted, now = [], time.time()
+    for root, dirs, files in os.walk(LOCAL_CACHE_PATH):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            path = os.path.join(root, name)
+            rel = cache_rel(os.path.relpath(path, LOCAL_CACHE_PATH))
+            if not rel or os.sep not in rel or name.startswith(".") or name.endswith(".part"):
+                continue
+            with _cache_lock:
+                if rel in cache_index:
+                    continue
+            try:
+                if now - os.stat(path).st_mtime < CACHE_STRAY_AGE:
+                    continue  # encore en cours d'écriture
+                dst = os.path.join(BASE_MODELS_PATH, rel)
+                if os.path.exists(dst):
+                    os.remove(path)  # index perdu : le volume fait foi
+                    continue
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copyfile(path, dst + ".part")
+                os.replace(dst + ".part", dst)
+                os.remove(path)
+            except OSError as e:
+                cache_state["last_error"] = f"rapatriement de {rel} : {e}"
+                continue
+            refresh_dir(os.path.dirname(dst))
+            print(f"📦 Rapatrié sur le volume réseau : {rel}")
+            adopted.append(rel)
+    return adopted
+
+def cache_evict(rel: str):
+    with _cache_lock:
+        cache_index.pop(rel, None)
+        safe = cache_rel(rel)
+        if safe:
+            try:
+                os.remove(os.path.join(LOCAL_CACHE_PATH, safe))
+            except OSError:
+                pass
+        _cache_save_index()
+
+def _cache_make_room(size: int, keep: set) -> bool:
+    """Évince en LRU (hors `keep`) jusqu'à tenir dans LOCAL_CACHE_MAX_GB et garder LOCAL_CACHE_MIN_FREE_GB libres."""
+    GB = 1_073_741_824
+    # Refus d'emblée si même un cache vidé de tout ce qui est évinçable ne suffirait pas :
+    # sinon un fichier trop gros viderait tout le cache pour rien
+    disk = shutil.disk_usage(LOCAL_CACHE_PATH)
+    if size > LOCAL_CACHE_MAX_GB * GB or size > disk.total - LOCAL_CACHE_MIN_FREE_GB * GB:
+        return False
+    kept = sum(e["size"] for rel, e in cache_index.items() if rel in keep)
+    evictable = sum(e["size"] for rel, e in cache_index.items() if rel not in keep)
+    if kept + size > LOCAL_CACHE_MAX_GB * GB or disk.free + evictable - size < LOCAL_CACHE_MIN_FREE_GB * GB:
+        return False
+    while True:
+        used = sum(e["size"] for e in cache_index.values())
+        free = shutil.disk_usage(LOCAL_CACHE_PATH).free
+        if used + size <= LOCAL_CACHE_MAX_GB * GB and free - size >= LOCAL_CACHE_MIN_FREE_GB * GB:
+            return True
+        for rel, e in cache_index.items():
+            # ComfyUI lit la copie locale : l'atime (relatime) reflète l'usage réel
+            try:
+                e["last_used"] = max(e["last_used"], os.stat(os.path.join(LOCAL_CACHE_PATH, rel)).st_atime)
+            except OSError:
+                pass
+        victims = sorted((rel for rel in cache_index if rel not in keep), key=lambda r: cache_index[r]["last_used"])
+        if not victims:
+            return False
+        cache_evict(victims[0])
+        inc("manager_cache_evictions_total", 1, "Fichiers évincés du cache local")
+
+def cache_copy(rel: str, keep: set = frozenset()) -> str:
+    """Met un fichier du volume réseau en cache local ; renvoie "hit" ou "copied"."""
+    if cache_rel(rel) != rel:
+        raise ValueError(f"chemin refusé : {rel}")
+    src = os.path.join(BASE_MODELS_PATH, rel)
+    dst = os.path.join(LOCAL_CACHE_PATH, rel)
+    st = os.stat(src)
+    with _cache_lock:
+        e = cache_index.get(rel)
+        if e and e["size"] == st.st_size and e["src_mtime_ns"] == st.st_mtime_ns and os.path.exists(dst):
+            e["last_used"] = time.time()
+            return "hit"
+        if not _cache_make_room(st.st_size, keep | {rel}):
+            raise RuntimeError(f"cache local plein ({LOCAL_CACHE_MAX_GB:.0f} Go) pour {rel}")
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + ".part"
+    t0 = time.perf_counter()
+    shutil.copyfile(src, tmp)
+    fp = _fingerprint(src, st.st_size)
+    if _fingerprint(tmp, st.st_size) != fp:
+        os.remove(tmp)
+        raise RuntimeError(f"copie corrompue : {rel}")
+    os.replace(tmp, dst)
+    observe("manager_cache_copy_seconds", time.perf_counter() - t0, "Durée des copies vers le cache local")
+    with _cache_lock:
+        cache_index[rel] = {"size": st.st_size, "src_mtime_ns": st.st_mtime_ns, "fingerprint": fp,
+                            "cached_at": time.time(), "last_used": time.time()}
+        _cache_save_index()
+    return "copied"
+
+def cache_verify() -> dict:
+    """Compare chaque copie locale au fichier réseau ; évince les copies obsolètes ou corrompues."""
+    ok, evicted = 0, []
+    for rel, e in list(cache_index.items()):
+        src, dst = os.path.join(BASE_MODELS_PATH, rel), os.path.join(LOCAL_CACHE_PATH, rel)
+        try:
+            st = os.stat(src)
+            valid = (st.st_size == e["size"] and st.st_mtime_ns == e["src_mtime_ns"]
+                     and _fingerprint(dst, e["size"]) == e["fingerprint"] == _fingerprint(src, st.st_size))
+        except OSError:
+            valid = False
+        if valid:
+            ok += 1
+        else:
+            cache_evict(rel)
+            evicted.append(rel)
+    return {"ok": ok, "evicted": evicted}
+
+def _model_refs(obj, out: set):
+    """Collecte les valeurs qui ressemblent à un nom de modèle dans un workflow ComfyUI (API ou UI)."""
+    if isinstance(obj, dict):
+        for v in obj.values():
+            _model_refs(v, out)
+    elif isinstance(obj, list):
+        for v in obj:
+            _model_refs(v, out)
+    elif isinstance(obj, str) and os.path.splitext(obj)[1].lower() in ALLOWED_EXTENSIONS - {".yaml"}:
+        out.add(obj.replace("\\", "/").lower())
+    return out
+
+def resolve_network_models(names: set) -> list:
+    """Noms de workflow ("flux/ae.safetensors" ou "ae.safetensors") -> chemins "catégorie/chemin" sur le volume."""
+    rels = []
+    for cat, files in scan_models_dir().items():
+        for f in files:
+            p = f["path"].lower()
+            if not f.get("is_folder") and any(p == n or p.endswith("/" + n) for n in names):
+                rels.append(f"{cat}/{f['path']}")
+    return rels
+
+def recent_comfyui_models(max_items: int = 20) -> list:
+    try:
+        history = requests.get(f"{COMFYUI_URL}/history", params={"max_items": max_items}, timeout=5).json()
+    except Exception:
+        return []
+    return resolve_network_models(_model_refs(history, set()))
+
+def cache_enqueue(rels: list):
+    keep = set(rels)  # un bundle ne s'évince pas lui-même
+    for rel in rels:
+        if rel not in cache_state["pending"]:
+            cache_state["pending"].append(rel)
+            _cache_queue.put((rel, keep))
+    ensure_cache_worker()
+
+def _cache_loop():
+    os.makedirs(LOCAL_CACHE_PATH, exist_ok=True)
+    _cache_load_index()
+    try:
+        write_extra_model_paths()
+    except OSError as e:
+        cache_state["last_error"] = f"extra_model_paths : {e}"
+    while True:
+        try:
+            rel, keep = _cache_queue.get(timeout=LOCAL_CACHE_RECENT_INTERVAL or CACHE_STRAY_AGE)
+        except queue.Empty:
+            cache_adopt_strays()
+            if LOCAL_CACHE_RECENT_INTERVAL:
+                cache_enqueue(recent_comfyui_models())
+            continue
+        cache_state["copying"] = rel
+        try:
+            result = cache_copy(rel, keep)
+            inc("manager_cache_requests_total", 1, "Demandes de mise en cache local", result=result)
+            if result == "copied":
+                write_extra_model_paths()  # nouvelle catégorie éventuelle
+        except Exception as e:
+            cache_state["last_error"] = str(e)
+            inc("manager_cache_requests_total", 1, "Demandes de mise en cache local", result="error")
+        finally:
+            cache_state["copying"] = None
+            if rel in cache_state["pending"]:
+                cache_state["pending"].remove(rel)
+
+def ensure_cache_worker():
+    global _cache_worker
+    if _cache_worker is None or not _cache_worker.is_alive():
+        _cache_worker = threading.Thread(target=_cache_loop, name="local-cache", daemon=True)
+        _cache_worker.start()
+
+@app.get("/cache")
+async def cache_status():
+    GB = 1_073_741_824
+    with _cache_lock:
+        entries = [{"path": rel, **e} for rel, e in sorted(cache_index.items())]
+    used = sum(e["size"] for e in entries)
+    await run_in_threadpool(check_extra_model_paths)
+    return {**cache_state, "path": LOCAL_CACHE_PATH, "used_gb": round(used / GB, 2), "max_gb": LOCAL_CACHE_MAX_GB,
+            "entries": entries}
+
+@app.post("/cache/prewarm")
+async def cache_prewarm(request: Request):
+    """
+    Met en cache un « bundle » avant la première génération. Corps accepté :
+    {"family": "Flux"} (entrées du catalogue présentes sur disque), {"workflow": {...}}
+    (workflow ComfyUI, format API ou UI), {"files": ["loras/x.safetensors", ...]} ou {"recent": true}.
+    """
+    data = await request.json()
+    rels = [cache_rel(r) for r in data.get("files", [])]
+    if None in rels:
+        return JSONResponse({"status": "error", "message": "Chemin non autorisé"}, status_code=400)
+    if data.get("family"):
+        load_catalogue()
+        disk = await run_in_threadpool(scan_models_dir)
+        for item in catalogue_lookup(family=data["family"]):
+            found = _find_on_disk(item, disk)
+            if found and not found.get("is_folder"):
+                rels.append(f"{item['path'].split('/')[0]}/{found['path']}")
+    if data.get("workflow"):
+        rels += await run_in_threadpool(resolve_network_models, _model_refs(data["workflow"], set()))
+    if data.get("recent"):
+        rels += await run_in_threadpool(recent_comfyui_models)
+    rels = list(dict.fromkeys(rels))
+    if not rels:
+        return JSONResponse({"status": "error", "message": "Aucun modèle trouvé sur le volume pour ce bundle"}, status_code=404)
+    cache_enqueue(rels)
+    return {"status": "ok", "queued": rels}
+
+@app.post("/cache/verify")
+async def cache_verify_endpoint():
+    return await run_in_threadpool(cache_verify)
+
+@app.post("/cache/evict")
+async def cache_evict_endpoint(request: Request):
+    data = await request.json()
+    rel = cache_rel(data.get("path", ""))
+    if not rel:
+        return JSONResponse({"status": "error", "message": "Chemin non autorisé"}, status_code=400)
+    if rel not in cache_index:
+        return JSONResponse({"status": "error", "message": "Absent du cache"}, status_code=404)
+    cache_evict(rel)
+    return {"status": "ok"}
+
 @app.delete("/delete")
 async def delete(cat: str, file: str):
     clean_cat = cat.replace(BASE_MODELS_PATH, "").lstrip("/")
@@ -426,21 +1562,67 @@ async def delete(cat: str, file: str):
         shutil.rmtree(p)
     elif os.path.exists(p):
         os.remove(p)
+    # La copie locale ne doit pas survivre au fichier réseau
+    rel = cache_rel(os.path.relpath(p, BASE_MODELS_PATH)) or ""
+    for cached in [r for r in cache_index if r == rel or r.startswith(rel + "/")]:
+        cache_evict(cached)
     return {"status": "ok"}
 
+def record_dir_scan(kind: str, t0: float, entries: int):
+    observe("manager_dir_scan_seconds", time.perf_counter() - t0, "Durée des parcours de BASE_MODELS_PATH", kind=kind)
+    inc("manager_dir_scan_entries_total", entries, "Entrées rencontrées par les parcours disque", kind=kind)
+
+def collect_download_metrics():
+    """Instantané aria2 + scheduler, relevé à chaque scrape."""
+    queued = sum(1 for j in list(download_jobs.values()) if not j.get("held"))
+    set_gauge("manager_download_jobs", len(download_jobs), "Téléchargements suivis par le scheduler")
+    set_gauge("manager_download_queue_depth", queued, "Jobs du scheduler non retenus (actifs ou en file)")
+    try:
+        stats = get_client().get_stats()
+        set_gauge("aria2_download_speed_bytes", stats.download_speed, "Débit agrégé aria2 (octets/s)")
+        set_gauge("aria2_downloads", stats.num_active, "Téléchargements aria2 par état", state="active")
+        set_gauge("aria2_downloads", stats.num_waiting, state="waiting")
+        set_gauge("aria2_downloads", stats.num_stopped, state="stopped")
+        set_gauge("aria2_up", 1, "aria2 joignable en RPC")
+    except Exception:
+        set_gauge("aria2_up", 0, "aria2 joignable en RPC")
+
+@app.get("/metrics")
+async def metrics():
+    await run_in_threadpool(collect_download_metrics)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.post("/purge")
 async def purge():
     client = get_client()
     if client: client.purge()
     return {"status": "ok"}
 
-if __name__ == "__main__":
-    subprocess.run(["pkill", "-9", "aria2c"])
-    time.sleep(1)
-    subprocess.Popen([
-        "aria2c", "--enable-rpc", "--rpc-listen-all=true",
-        "--rpc-allow-origin-all=true", "--max-concurrent-downloads=6",
+def aria2_running() -> bool:
+    try:
+        get_client().client.get_version()
+        return True
+    except Exception:
+        return False
+
+def start_aria2():
+    cmd = [
+        "aria2c", "--enable-rpc", "--rpc-listen-all=true", f"--rpc-listen-port={ARIA2_RPC_PORT}",
+        "--rpc-allow-origin-all=true", f"--max-concurrent-downloads={MAX_ACTIVE_DOWNLOADS}",
         "--follow-torrent=mem", "--rpc-save-upload-metadata=true",
-        "--optimize-concurrent-downloads=false", "-D"
-    ])
+        "--optimize-concurrent-downloads=false",
+        f"--max-overall-download-limit={DOWNLOAD_MAX_BANDWIDTH}",
+        # Session : la file (y compris en pause) survit à un arrêt d'aria2
+        f"--save-session={ARIA2_SESSION_PATH}", "--save-session-interval=30",
+        "--auto-save-interval=30", "--force-save=false", "-D",
+    ]
+    if os.path.exists(ARIA2_SESSION_PATH):
+        cmd.append(f"--input-file={ARIA2_SESSION_PATH}")
+    subprocess.Popen(cmd)
+
+if __name__ == "__main__":
+    # On ne tue plus aria2 au démarrage : s'il tourne encore, ses téléchargements continuent
+    if not aria2_running():
+        start_aria2()
+        time.sleep(1)
     uvicorn.run(app, host="0.0.0.0", port=8080)